@@ -36,6 +36,9 @@ class CDrawObjectGimp(fo.CDrawObjectBase):
 
    effects_ranks = fo.merge_dicts(fo.CDrawObjectBase.effectsRanks(),{
    })
+
+   ## Directory of saved images of root objects
+   output_dir = "/home/tomaqa/Data/Pics/Hry/Mysteria/v1.10/Karty/gen/"
 ########################################
    def Resize(self, item):
       item.resize(max(1,self.Width_px), max(1,self.Height_px))
@@ -45,11 +48,14 @@ class CDrawObjectGimp(fo.CDrawObjectBase):
       if self.parent != None and isinstance(self.parent.draw, CDrawObjectGimp):
          self.parent.draw.ResizeLayerRec()
 
+   def OutputPath(self):
+      return self.output_dir+self.figure.IdxNamePrefix+self.key.title()+".xcf"
+
    def CreateImage(self):
       img = gimp.Image(1, 1, RGB)
       img.disable_undo()
       self.Resize(img)
-      img.filename = "/home/tomaqa/Data/Pics/Hry/Mysteria/v1.10/Karty/gen/"+self.figure.IdxNamePrefix+self.key.title()+".xcf"
+      img.filename = self.OutputPath()
       return img
 
    def CreateLayer(self, alpha=True):
@@ -277,6 +283,10 @@ class CDrawFigureGimp(fig.CDrawFigureBase):
    ## All default values off class' possible attributes should be defined
    attr_defaults = fo.merge_dicts(fig.CDrawFigureBase.attrDefaults(),{
    })
+########################################
+   ## Each root object is saved to its own image
+   def OutputPaths(self):
+      return [obj.draw.OutputPath() for obj in self.ptr.root_objects if isinstance(obj.draw, CDrawObjectGimp)]
 ################################################################################
 
 
@@ -4,9 +4,16 @@
 ## that handles a list of 'CFigure's
 
 from __future__ import division
+from collections import deque
 import copy as cp
 
+import json
+import multiprocessing
+import os
+import re
+import StringIO
 import sys
+import traceback
 import logging as log
 
 log.basicConfig(stream=sys.stdout, level=log.WARNING)
@@ -58,6 +65,24 @@ class CLoader(fo.CCompositionBase):
    def AcceptFigureAttr(self, attrs, attr_key, attr_val):
       return attr_val
 
+   ## Whether figures of the collection use attribute 'attr_key'
+   ## of draw or layout figure (by 'attrs_key'):
+   ## all possible attributes of their classes have defaults
+   ## and any layout attribute can add a layout
+   def IsFigureAttrUsed(self, attrs_key, attr_key):
+      collection = self.ptr
+      if attrs_key == 'tmp_draw_attrs':
+         class_ = collection.draw_figure_class
+         if class_ == None:
+            class_ = fig.CFigure.default_draw_figure_class
+      else:
+         if fig.layout_registry.AttrLayoutKey(attr_key) != None:
+            return True
+         class_ = collection.layout_figure_class
+         if class_ == None:
+            class_ = fig.CFigure.default_layout_figure_class
+      return attr_key in class_.attrDefaults()
+
    ## No need to override this
    def SetFigureAttr(self, attrs_key, attr_key, attr_val):
       attrs = getattr(self, attrs_key)
@@ -65,13 +90,27 @@ class CLoader(fo.CCompositionBase):
       if self.AcceptFigureAttr(attrs, attr_key, attr_val):
          attrs[attr_key] = fo.merge_dicts(attrs[attr_key], attr_val) if attr_key in attrs else attr_val
 ########################################
-   ## Fill collection with figures attributes
-   ## by calling 'AddFigureAttrs'.
+   ## Returns attributes of figure set so far
+   ## (pair of draw and layout figure attributes) and resets them
+   def popFigureAttrs(self):
+      figure_attrs = (self.tmp_draw_attrs, self.tmp_layout_attrs)
+      self.tmp_draw_attrs = {}
+      self.tmp_layout_attrs = {}
+      return figure_attrs
+
+   ## Yields figures attributes (see 'popFigureAttrs') one by one,
+   ## as they are read from 'src'.
    ## Override this - only dummy usage example
-   def loadFiguresAttrs(self, src, **args):
+   def iterFiguresAttrs(self, src, **args):
       self.SetFigureAttr('tmp_layout_attrs', 'layout_key', 'value')
       self.SetFigureAttr('tmp_draw_attrs', 'draw_key', 'value')
-      self.AddFigureAttrs()
+      yield self.popFigureAttrs()
+
+   ## Fill collection with figures attributes
+   ## by calling 'AddFigureAttrs'.
+   def loadFiguresAttrs(self, src, **args):
+      for draw_figure_args, layout_figure_args in self.iterFiguresAttrs(src, **args):
+         self.AddFigureAttrs(draw_figure_args, layout_figure_args)
 
    ## Check if this 'src' has not been already loaded.
    ## If not, call 'loadAttrs'.
@@ -81,6 +120,167 @@ class CLoader(fo.CCompositionBase):
          return False
       self.loadFiguresAttrs(src, **args)
       return True
+
+   ## Same as 'LoadFiguresAttrs', but figures attributes
+   ## are yielded instead of being filled into collection
+   ## Do not override this
+   def IterFiguresAttrs(self, src, **args):
+      if not self.AddSource(src):
+         return iter(())
+      return self.iterFiguresAttrs(src, **args)
+################################################################################
+
+## Parser of Python literals in values of loaded records:
+## (nested) dictionaries, lists, tuples, strings, numbers, 'True', 'False' and 'None'.
+## Nothing is evaluated, so records from any source are safe to load.
+## Tokens are punctuations, strings and words (numbers and constants),
+## any other character is a token too (it is invalid).
+## Whitespace between tokens is skipped by not matching at all.
+literal_token_re = re.compile(r"""
+   [][{}(),:]
+   |'[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*"
+   |[^][{}(),:'"\s]+
+   |\S
+""", re.X)
+literal_number_re = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\Z")
+literal_constants = {'True': True, 'False': False, 'None': None}
+literal_closings = {'{': '}', '[': ']', '(': ')'}
+literal_punctuations = frozenset('[]{}(),:')
+
+class CLiteralError(ValueError):
+   """
+   Error of literal at its token index 'idx'
+   (see 'literal_tokens'),
+   message is completed with position in the literal by 'parse_literal'
+   """
+   def __init__(self, msg, idx):
+      ValueError.__init__(self, msg)
+      self.idx = idx
+
+## Parsed values of tokens that are not punctuations by their text,
+## values are immutable, so they are shared
+literal_values = dict(literal_constants)
+literal_values_size = 4096
+
+## Value of token (see 'literal_token_re') at index 'idx'
+## that is not a punctuation
+def literal_token_value(token, idx):
+   if token in literal_values:
+      return literal_values[token]
+   if token == None:
+      raise CLiteralError("Unexpected end of literal", idx)
+   if token[0] == "'" or token[0] == '"':
+      val = token[1:-1]
+      if '\\' in val:
+         val = val.decode('string_escape')
+   elif literal_number_re.match(token):
+      val = float(token) if '.' in token or 'e' in token or 'E' in token else int(token)
+   else:
+      raise CLiteralError("Unexpected %r" % token, idx)
+   if len(literal_values) >= literal_values_size:
+      literal_values.clear()
+      literal_values.update(literal_constants)
+   literal_values[token] = val
+   return val
+
+## Returns pair of value parsed from tokens (see 'literal_token_re')
+## at index 'idx' and index of the following token.
+## Tokens end with 'None' (see 'parse_literal'),
+## values that are not collections are parsed inline
+def parse_literal_value(tokens, idx):
+   punct = tokens[idx]
+   if punct not in literal_punctuations:
+      return literal_token_value(punct, idx), idx+1
+   closing = literal_closings.get(punct)
+   if closing == None:
+      raise CLiteralError("Unexpected %r" % punct, idx)
+   begin = idx
+   items = []
+   comma = False
+   idx += 1
+   while tokens[idx] != closing:
+      if punct == '{':
+         key = tokens[idx]
+         if key in literal_values:
+            key = literal_values[key]
+            idx += 1
+         elif key in literal_punctuations:
+            key, idx = parse_literal_value(tokens, idx)
+         else:
+            key = literal_token_value(key, idx)
+            idx += 1
+         if tokens[idx] != ':':
+            raise expected_literal_token(tokens, idx, ':')
+         idx += 1
+      item = tokens[idx]
+      if item in literal_values:
+         item = literal_values[item]
+         idx += 1
+      elif item in literal_punctuations:
+         item, idx = parse_literal_value(tokens, idx)
+      else:
+         item = literal_token_value(item, idx)
+         idx += 1
+      items.append(item if punct != '{' else (key, item))
+      if tokens[idx] != ',':
+         if tokens[idx] != closing:
+            raise expected_literal_token(tokens, idx, closing)
+         break
+      comma = True
+      idx += 1
+   idx += 1
+   if punct == '{':
+      try:
+         return fo.CFrozenDict(items), idx
+      except TypeError:
+         raise CLiteralError("Unhashable key of dictionary", begin)
+   if punct == '(':
+      ## Parentheses without comma only group the value
+      return (tuple(items) if comma or not items else items[0]), idx
+   return items, idx
+
+def expected_literal_token(tokens, idx, punct):
+   if tokens[idx] == None:
+      return CLiteralError("Expected %r at the end of literal" % punct, idx)
+   return CLiteralError("Expected %r" % punct, idx)
+
+## Copy of parsed literal with new lists
+## (dictionaries are frozen and so shared)
+def copy_literal(val):
+   if isinstance(val, list):
+      return [copy_literal(item) for item in val]
+   if isinstance(val, tuple):
+      return tuple(copy_literal(item) for item in val)
+   if fo.is_frozen_dict(val):
+      return fo.CFrozenDict((key, copy_literal(item)) for key, item in val.iteritems())
+   return val
+
+## Parsed literals by their text,
+## values are shared, thus dictionaries are frozen
+## and values with lists are copied
+literals_cache = {}
+literals_cache_size = 4096
+
+## Raises 'ValueError' with position in 'text' if it is not a valid literal
+def parse_literal(text):
+   val = literals_cache.get(text, fo.DEFAULT)
+   if val is not fo.DEFAULT:
+      return val if '[' not in text else copy_literal(val)
+   try:
+      tokens = literal_token_re.findall(text)
+      tokens.append(None)
+      val, idx = parse_literal_value(tokens, 0)
+      if tokens[idx] != None:
+         raise CLiteralError("Unexpected %r" % tokens[idx], idx)
+   except CLiteralError as e:
+      ## Positions of tokens are evaluated only on error
+      positions = [match.start() for match in literal_token_re.finditer(text)]
+      pos = positions[e.idx] if e.idx < len(positions) else len(text)
+      raise ValueError("%s at position %d" % (e, pos))
+   if len(literals_cache) >= literals_cache_size:
+      literals_cache.clear()
+   literals_cache[text] = val
+   return val if '[' not in text else copy_literal(val)
 ################################################################################
 
 ################################################################################
@@ -94,43 +294,245 @@ class CLoaderDSV(CLoader):
    with the same syntax as in Python,
    but delimiter has to be different from 'dict' symbols [{,:}]
    and the value must start with '{'.
+   Values of 'dict's can be only literals (see 'parse_literal'),
+   loaded 'dict's are frozen.
+   Columns that figures of the collection do not use are skipped
+   (see 'IsFigureAttrUsed'), unless 'skip_unused_columns' is off.
    """
 ########################################
    ## All default values off class' possible attributes should be defined
    ## These defaults takes precedence over 'CDrawFigure...' defaults
    attr_defaults = fo.merge_dicts(CLoader.attrDefaults(),{
       'delim' : '\t',
+      'skip_unused_columns' : True,
    })
 ########################################
    ## Draw figure attributes should be prefixed with 'd'.
    ## Layout figure attributes can be prefixed with 'l',
    ## but don't have to - it acts as default.
-   def loadFiguresAttrs(self, src, delim=None):
+   ## Returns plan of header 'keys' with used columns only:
+   ## list of tuples (column index, column key,
+   ## index of attributes in pair of draw and layout figure attributes,
+   ## attribute key, whether to merge it with previous value),
+   ## merging is needed only if more columns set the same attribute
+   def compileHeader(self, keys):
+      plan = []
+      for idx, key in enumerate(keys):
+         split_ = key.split("_",1)
+         is_default = len(split_) == 1 or split_[0] not in ['d','l']
+         is_layout = split_[0] == 'l'
+         attrs_key = 'tmp_layout_attrs' if is_default or is_layout else 'tmp_draw_attrs'
+         attr_key = key if is_default else split_[1]
+         if self.skip_unused_columns and not self.IsFigureAttrUsed(attrs_key, attr_key):
+            log.info("Skipping unused column '%s'", key)
+            continue
+         plan.append((idx, key, int(attrs_key == 'tmp_layout_attrs'), attr_key))
+      targets = [(attrs_idx, attr_key) for idx, key, attrs_idx, attr_key in plan]
+      return [column+(targets.count(column[2:]) > 1,) for column in plan]
+
+   ## Values that start with '{' are parsed as literals
+   def iterFiguresAttrs(self, src, delim=None):
       if not delim:
          delim = self.delim
       with open(src) as csvfile:
-         reader = csv.DictReader(csvfile, delimiter=delim)
-      
-         for row in reader:
-            for key in row.keys():
-               split_ = key.split("_",1)
-               val = row[key]
-               ## Possibly convert to dict
+         reader = csv.reader(csvfile, delimiter=delim)
+         keys = next(reader, None)
+         if keys == None:
+            return
+         plan = self.compileHeader(keys)
+
+         for values in reader:
+            if not values:
+               continue
+            figure_attrs = ({}, {})
+            for idx, key, attrs_idx, attr_key, merge in plan:
+               val = values[idx] if idx < len(values) else None
                if val and val[0] == '{':
-                  val = eval(val)
-
-               is_default = len(split_) == 1 or split_[0] not in ['d','l']
-               is_layout = split_[0] == 'l'
-               attrs_key = 'tmp_layout_attrs' if is_default or is_layout else 'tmp_draw_attrs'
-               attr_key = key if is_default else split_[1]
-               
-               self.SetFigureAttr(attrs_key, attr_key, val)
-            self.AddFigureAttrs()
+                  try:
+                     val = parse_literal(val)
+                  except ValueError as e:
+                     raise ValueError("%s: row %d, column %d ('%s'): %s" % (
+                        src, reader.line_num, idx+1, key, e
+                     ))
+               attrs = figure_attrs[attrs_idx]
+               if self.AcceptFigureAttr(attrs, attr_key, val):
+                  attrs[attr_key] = fo.merge_dicts(attrs[attr_key], val) if merge and attr_key in attrs else val
+            yield figure_attrs
 ################################################################################
 
 ################################################################################
 ################################################################################
 
+## Layout plans of worker process by path of their cache
+## ('None' for plans kept in memory), see 'doFigureInProcess'
+process_layout_plans = {}
+
+## Worker of 'CFigCollection' with 'process' executor:
+## creates, lays out and draws one figure from its inputs (see 'figureTask')
+## and returns tuple of whether any layout was processed,
+## output of the figure, its layout plan (see 'Record' in 'CLayoutPlans'),
+## records of layout profiler and formatted exception if it failed.
+def doFigureInProcess(task):
+   idx, name, figure_args, set_args, geometry_class, layout_plans_path, profiled, force_draw = task
+   stdout = sys.stdout
+   sys.stdout = output = StringIO.StringIO()
+   try:
+      figure = fig.CFigure(idx=idx, name=name, **figure_args)
+      figure.Set(**set_args)
+      figure.SetGeometryClass(geometry_class)
+      if layout_plans_path != False:
+         if layout_plans_path not in process_layout_plans:
+            process_layout_plans[layout_plans_path] = (fig.CLayoutPlans() if layout_plans_path == None
+               else fig.CLayoutCache(layout_plans_path)
+            )
+         figure.SetLayoutPlans(process_layout_plans[layout_plans_path])
+      profiler = fig.CLayoutProfiler() if profiled else None
+      figure.SetLayoutProfiler(profiler)
+      ret = figure.Do(force_draw=force_draw)
+      plan = fig.CLayoutPlans().Record(figure, ret)
+      return (ret, output.getvalue(), plan, None if profiler == None else profiler.records, None)
+   except Exception:
+      return (None, output.getvalue(), None, None, traceback.format_exc())
+   finally:
+      sys.stdout = stdout
+################################################################################
+
+################################################################################
+class CBuildManifest(object):
+   """
+   Class of manifest of incremental builds of figures,
+   stored in JSON file 'path'.
+   Each figure (by its index and name, see 'IdxNamePrefix' in 'CFigure')
+   maps to digest of its inputs and code of its layouts
+   (see 'FigureDigest' in 'CLayoutPlans'),
+   states of asset files referenced by 'path' attributes of its effects
+   (including default ones)
+   and paths of its outputs (see 'OutputPaths' in 'CDrawFigureBase').
+   Figure is up to date if all of them are unchanged
+   and its outputs still exist.
+   Summary of build lists keys of rebuilt and skipped figures
+   and removed outputs that are not produced anymore.
+   Figures that are not processed (e.g. from other input files)
+   are kept, unless they are pruned (see 'Finish').
+   """
+########################################
+   def __init__(self, path):
+      self.path = path
+      self.plans = fig.CLayoutPlans()
+      try:
+         with open(path, 'rb') as f:
+            self.entries = json.load(f)
+      except (IOError, ValueError):
+         self.entries = {}
+      self.ClearSummary()
+
+   def ClearSummary(self):
+      self.rebuilt = []
+      self.skipped = []
+      self.stale_outputs = set()
+      self.visited = set()
+      ## Figure key -> digest of its inputs before it was processed
+      self.digests = {}
+########################################
+   @staticmethod
+   def FigureKey(figure):
+      key = figure.IdxNamePrefix.rstrip('-_')
+      return key if key else str(figure.idx)
+
+   ## Modification time and size, 'None' if the file does not exist
+   @staticmethod
+   def assetState(path):
+      try:
+         stat = os.stat(path)
+      except OSError:
+         return None
+      return [stat.st_mtime, stat.st_size]
+
+   def figureAssets(self, figure):
+      paths = set()
+      objects = list(figure.root_objects)
+      while objects:
+         obj = objects.pop()
+         objects.extend(obj.objects_ordered)
+         if obj.draw == None:
+            continue
+         effects_attr_defaults = obj.draw.EffectsAttrDefaults()
+         for effect in obj.draw.effects_ordered:
+            path = effect.attrs.get('path', effects_attr_defaults.get(effect.key, {}).get(effect.type, {}).get('path'))
+            if isinstance(path, basestring):
+               paths.add(path)
+      return dict((path, self.assetState(path)) for path in paths)
+########################################
+   ## Must be called before the figure is processed,
+   ## figures that are not untouched since their creation are never up to date
+   def IsUpToDate(self, figure):
+      key = self.FigureKey(figure)
+      self.visited.add(key)
+      digest = None
+      if figure.draw != None and figure.layout != None and self.plans.IsFigureFresh(figure):
+         digest = self.plans.FigureDigest(figure)
+      self.digests[key] = digest
+      entry = self.entries.get(key)
+      if digest == None or entry == None or entry['digest'] != digest:
+         return False
+      return (all(self.assetState(path) == state for path, state in entry['assets'].items())
+         and all(os.path.exists(path) for path in entry['outputs'])
+      )
+
+   def Skip(self, figure):
+      key = self.FigureKey(figure)
+      self.visited.add(key)
+      self.skipped.append(key)
+
+   ## Records processed figure
+   def Update(self, figure):
+      key = self.FigureKey(figure)
+      self.visited.add(key)
+      outputs = [] if figure.draw == None else figure.draw.OutputPaths()
+      if key in self.entries:
+         self.stale_outputs.update(set(self.entries[key]['outputs'])-set(outputs))
+      self.entries[key] = {
+         'digest': self.digests.pop(key, None),
+         'assets': self.figureAssets(figure),
+         'outputs': outputs,
+      }
+      self.rebuilt.append(key)
+########################################
+   ## File is written at once, so that it is never read incomplete
+   def Save(self):
+      tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+      with open(tmp_path, 'wb') as f:
+         json.dump(self.entries, f, indent=1, sort_keys=True)
+      os.rename(tmp_path, self.path)
+
+   ## Outputs that rebuilt figures do not produce anymore are removed
+   ## unless another figure produces them.
+   ## With 'prune', also figures that were not visited since the last finish
+   ## are dropped and their outputs are removed,
+   ## so it is meant only for builds of all figures.
+   ## Returns summary of the build and starts a new one.
+   def Finish(self, prune=False):
+      if prune:
+         for key in [key for key in self.entries if key not in self.visited]:
+            self.stale_outputs.update(self.entries.pop(key)['outputs'])
+      outputs = set(path for entry in self.entries.values() for path in entry['outputs'])
+      removed = []
+      for path in sorted(self.stale_outputs-outputs):
+         if os.path.exists(path):
+            os.remove(path)
+            removed.append(path)
+      self.Save()
+      summary = {'rebuilt': self.rebuilt, 'skipped': self.skipped, 'removed': removed}
+      self.ClearSummary()
+      return summary
+
+   @staticmethod
+   def SummaryStr(summary):
+      return "\n".join("%s %d %s%s" % (title, len(summary[key]), what, "" if not summary[key] else ": "+", ".join(summary[key]))
+         for key, title, what in [('rebuilt', "Rebuilt", "figures"), ('skipped', "Skipped", "figures"), ('removed', "Removed", "outputs")]
+      )
+################################################################################
+
 ################################################################################
 class CFigCollection(object):
    """
@@ -148,6 +550,13 @@ class CFigCollection(object):
       layout_figure_args={},
       draw_figure_class=None, draw_object_class=None,
       layout_figure_class=None,
+      geometry_class=None,
+      layout_plans=None,
+      layout_pool=None,
+      layout_profiler=None,
+      layout_cache_path=None,
+      executor='serial', workers=None,
+      build_manifest_path=None,
    ):
       self.SetSharedResolution(resolution_ppi)
       self.SetSharedWidth(width_mm)
@@ -159,9 +568,23 @@ class CFigCollection(object):
       self.draw_figure_class = draw_figure_class
       self.draw_object_class = draw_object_class
       self.layout_figure_class = layout_figure_class
+      self.geometry_class = geometry_class
+      ## Laid out trees of figures are reused from disk if path is given
+      ## (see 'CLayoutCache')
+      if layout_plans == None and layout_cache_path != None:
+         layout_plans = fig.CLayoutCache(layout_cache_path)
+      self.layout_plans = layout_plans
+      self.layout_pool = layout_pool
+      self.layout_profiler = layout_profiler
+      self.SetExecutor(executor, workers)
+      self.SetBuildManifest(build_manifest_path)
 
       self.figures = []
       self.figures_pos = -1
+      self.streamed_figures_count = 0
+
+      ## Inputs of added figures (see 'figureTask')
+      self.figures_inputs = []
       
       self.figures_draw_figure_args = []
       self.figures_layout_figure_args = []
@@ -176,6 +599,34 @@ class CFigCollection(object):
 ########################################
    def SetLoader(self, loader_class, **args):
       self.loader = loader_class(self, **args)
+########################################
+   executors = ['serial', 'process']
+
+   ## How 'DoFigures' processes figures:
+   ## 'serial' one after another,
+   ## 'process' in 'workers' processes ('None' means count of CPUs),
+   ## which is meant for draw tools that can run in any process
+   ## (e.g. printing or producing files, not Gimp)
+   def SetExecutor(self, executor='serial', workers=None):
+      if executor not in self.executors:
+         raise ValueError("Unknown executor '%s', expected one of: %s." % (executor, ", ".join(self.executors)))
+      self.executor = executor
+      self.workers = workers
+########################################
+   ## Figures that are up to date in the manifest are skipped by 'DoFigures'
+   ## (see 'CBuildManifest'), call 'FinishBuild' after all figures are done
+   def SetBuildManifest(self, path=None):
+      self.build_manifest = None if path == None else CBuildManifest(path)
+
+   ## Returns summary of the build, 'None' without manifest
+   ## ('prune' is meant only if all figures were processed,
+   ## see 'Finish' in 'CBuildManifest')
+   def FinishBuild(self, prune=False):
+      if self.build_manifest == None:
+         return None
+      summary = self.build_manifest.Finish(prune)
+      print CBuildManifest.SummaryStr(summary)
+      return summary
 ########################################
    @property
    def FiguresCount(self):
@@ -250,12 +701,23 @@ class CFigCollection(object):
       draw_figure_args = self.AttrsFromShared(idx, 'draw_figure_args', **draw_figure_args)
       layout_figure_args = self.AttrsFromShared(idx, 'layout_figure_args', **layout_figure_args)
 
+      figure = self.CreateFigure(idx, resolution_ppi, width_mm, height_mm, draw_figure_args, layout_figure_args)
+      self.figures_inputs.append((resolution_ppi, width_mm, height_mm, draw_figure_args, layout_figure_args))
+      self.addFigure(figure)
+      return figure
+
+   ## Figure set with all the collection's settings,
+   ## but not added to the collection
+   def CreateFigure(self, idx, resolution_ppi, width_mm, height_mm, draw_figure_args, layout_figure_args):
       figure = fig.CFigure(resolution_ppi=resolution_ppi, width_mm=width_mm, height_mm=height_mm, idx=idx)
       figure.Set(draw_figure_class=self.draw_figure_class, draw_object_class=self.draw_object_class,
          layout_figure_class=self.layout_figure_class,
          draw_figure_args=draw_figure_args, layout_figure_args=layout_figure_args
       )
-      self.addFigure(figure)
+      figure.SetGeometryClass(self.geometry_class)
+      figure.SetLayoutPlans(self.layout_plans)
+      figure.SetLayoutPool(self.layout_pool)
+      figure.SetLayoutProfiler(self.layout_profiler)
       return figure
 ########################################
    def LoadFiguresAttrs(self, src, **args):
@@ -268,20 +730,159 @@ class CFigCollection(object):
       for idx in range(count):
          self.AddFigure()
 ########################################
+   ## Only complete processing of figures is recorded in the build manifest
    def DoFigures(self, rank_step=None, layout_step=None, force_draw=False):
       ret = False
       start = self.FiguresPos+1
       end = self.FiguresCount
-      for fig in self.figures[start:end]:
-         print "Processing %d. figure%s ..." % (fig.idx+1, "" if not fig.name else " '"+fig.name+"'")
-         ret |= fig.Do(rank_step=rank_step, layout_step=layout_step, force_draw=force_draw)
+      figures = self.figures[start:end]
+      manifest = self.build_manifest if rank_step == None and layout_step == None else None
+      if manifest != None:
+         figures = [figure for figure in figures if not self.skipUpToDateFigure(figure, force_draw)]
+      if self.executor == 'process' and rank_step == None and layout_step == None:
+         ret = self.doFiguresInProcesses(figures, force_draw)
+      else:
+         for fig in figures:
+            self.printProcessing(fig)
+            ret |= fig.Do(rank_step=rank_step, layout_step=layout_step, force_draw=force_draw)
+      if manifest != None:
+         for figure in figures:
+            manifest.Update(figure)
+         manifest.Save()
       self.figures_pos = end-1
       return ret
+
+   ## Digest of the figure is taken even if it is forced to be drawn
+   def skipUpToDateFigure(self, figure, force_draw):
+      if not self.build_manifest.IsUpToDate(figure) or force_draw:
+         return False
+      print "Skipping %d. figure%s (up to date) ..." % (figure.idx+1, "" if not figure.name else " '"+figure.name+"'")
+      self.build_manifest.Skip(figure)
+      return True
+
+   def printProcessing(self, figure):
+      print "Processing %d. figure%s ..." % (figure.idx+1, "" if not figure.name else " '"+figure.name+"'")
+
+   ## Inputs of figure for 'doFigureInProcess',
+   ## 'None' if the figure cannot be processed in other process
+   ## (it is not untouched since its creation)
+   def figureTask(self, figure, force_draw):
+      if figure.idx >= len(self.figures_inputs) or figure.draw == None or figure.layout == None:
+         return None
+      if not fig.CLayoutPlans().IsFigureFresh(figure):
+         return None
+      resolution_ppi, width_mm, height_mm, draw_figure_args, layout_figure_args = self.figures_inputs[figure.idx]
+      if self.layout_plans == None:
+         layout_plans_path = False
+      elif isinstance(self.layout_plans, fig.CLayoutCache):
+         layout_plans_path = self.layout_plans.path
+      else:
+         layout_plans_path = None
+      return (figure.idx, figure.name,
+         {'resolution_ppi': resolution_ppi, 'width_mm': width_mm, 'height_mm': height_mm},
+         {'draw_figure_class': self.draw_figure_class, 'draw_object_class': self.draw_object_class,
+            'layout_figure_class': self.layout_figure_class,
+            'draw_figure_args': draw_figure_args, 'layout_figure_args': layout_figure_args,
+         },
+         self.geometry_class, layout_plans_path, self.layout_profiler != None,
+         force_draw,
+      )
+
+   ## Figures are laid out and drawn in worker processes,
+   ## their outputs are printed in order of figures.
+   ## Laid out trees are replayed into the figures (see 'CLayoutPlans'),
+   ## so that they are the same as if they were processed here.
+   ## Figures that cannot be processed in other process are processed here in order.
+   ## The first failed figure raises 'RuntimeError' with its traceback.
+   def doFiguresInProcesses(self, figures, force_draw):
+      ret = False
+      tasks = [self.figureTask(figure, force_draw) for figure in figures]
+      pool = multiprocessing.Pool(self.workers)
+      try:
+         results = pool.imap(doFigureInProcess, [task for task in tasks if task != None])
+         for figure, task in zip(figures, tasks):
+            self.printProcessing(figure)
+            if task == None:
+               ret |= figure.Do(force_draw=force_draw)
+               continue
+            figure_ret, output, plan, profile, error = next(results)
+            sys.stdout.write(output)
+            if error != None:
+               raise RuntimeError("Processing %d. figure failed in worker process:\n%s" % (figure.idx+1, error))
+            fig.CLayoutPlans().Replay(figure, plan)
+            figure.ClearDrawDirty()
+            if profile != None:
+               for key, counters in profile.items():
+                  self.layout_profiler.addCounters(key, counters)
+            ret |= figure_ret
+         pool.close()
+      finally:
+         pool.terminate()
+         pool.join()
+      return ret
    
    def LoadAndDoFigures(self, src, rank_step=None, layout_step=None, force_draw=False, **load_args):
       self.LoadFiguresAttrs(src, **load_args)
       self.AddAllFigures()
       return self.DoFigures(rank_step=rank_step, layout_step=layout_step, force_draw=force_draw)
+########################################
+   ## Creates and lays out figure with attributes of one loaded record
+   ## merged with shared ones
+   def layoutStreamedFigure(self, idx, draw_figure_args, layout_figure_args, rank_step, layout_step):
+      figure = self.CreateFigure(idx,
+         self.AttrFromShared('resolution_ppi', None),
+         self.AttrFromShared('width_mm', None),
+         self.AttrFromShared('height_mm', None),
+         fo.merge_dicts(self.shared_draw_figure_args, draw_figure_args),
+         fo.merge_dicts(self.shared_layout_figure_args, layout_figure_args),
+      )
+      figure.DoLayout(rank_step, layout_step)
+      return figure
+
+   ## Streams figures from 'src' of the loader (see 'IterFiguresAttrs' in 'CLoader'):
+   ## each figure is created and laid out as soon as its attributes are loaded,
+   ## then it is drawn and yielded in order of loading.
+   ## Figures are not added to the collection,
+   ## so they are released as soon as the caller drops them.
+   ## If 'pool' (e.g. 'multiprocessing.pool.ThreadPool') is given,
+   ## figures are created and laid out in it,
+   ## at most 'window' of them at once (including the yielded one),
+   ## otherwise one by one.
+   ## Figures are always drawn in the calling thread.
+   def IterFigures(self, src, window=1, pool=None, rank_step=None, layout_step=None, force_draw=False, **load_args):
+      if self.loader == None:
+         return
+      if window < 1:
+         raise ValueError("Window of streamed figures must be at least 1, not %d." % window)
+      figures_attrs = self.loader.IterFiguresAttrs(src, **load_args)
+      pending = deque()
+      while True:
+         while len(pending) < (1 if pool == None else window):
+            figure_attrs = next(figures_attrs, None)
+            if figure_attrs == None:
+               break
+            idx = self.FiguresCount+self.streamed_figures_count
+            self.streamed_figures_count += 1
+            print "Processing %d. figure ..." % (idx+1)
+            args = (idx,)+figure_attrs+(rank_step, layout_step)
+            pending.append(self.layoutStreamedFigure(*args) if pool == None
+               else pool.apply_async(self.layoutStreamedFigure, args)
+            )
+         if not pending:
+            return
+         figure = pending.popleft()
+         if pool != None:
+            figure = figure.get()
+         figure.DoDraw(force_draw)
+         yield figure
+         figure = None
+
+   ## Returns count of streamed figures
+   def StreamFigures(self, src, window=1, pool=None, rank_step=None, layout_step=None, force_draw=False, **load_args):
+      count = 0
+      for figure in self.IterFigures(src, window, pool, rank_step, layout_step, force_draw, **load_args):
+         count += 1
+      return count
 ################################################################################
 
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python2
+
+## Library that evaluates geometry of whole 'CFigure's tree at once
+## with NumPy arrays instead of per-object property evaluation
+
+from __future__ import division
+
+import numpy as np
+
+################################################################################
+################################################################################
+
+################################################################################
+class CFigureGeometry(object):
+   """
+   Class that flattens figure objects tree
+   (figure's dummy object and all its subobjects)
+   into parallel arrays (struct of arrays)
+   and evaluates sizes and positions of all objects
+   in a few vectorized passes over depth levels.
+   Results are stored into geometry caches of figure objects
+   (see 'SetCachedGeometry' in 'CFigObject'),
+   so they are used transparently by all geometry properties.
+   Results are valid only until the tree is modified again.
+   It is meant to evaluate the whole tree before draw
+   (see 'SetGeometryClass' in 'CFigure').
+   Layouts query geometry of only a few objects between changes of the tree
+   (e.g. 'SetPosFromObject'), so they keep lazy evaluation per object,
+   as flattening the whole tree for each query would cost more.
+   """
+########################################
+   align_codes = [
+      {'left': 0, 'right': 1, 'center': 2},
+      {'top': 0, 'bottom': 1, 'center': 2},
+   ]
+########################################
+   def __init__(self, figure):
+      self.figure = figure
+      self.Flatten()
+########################################
+   ## Objects are ordered by depth levels (breadth-first),
+   ## thus parents always precede their subobjects
+   def Flatten(self):
+      objects = [self.figure._dummy_object]
+      parents = [-1]
+      levels = [0]
+      for idx, obj in enumerate(objects):
+         for subobj in obj.objects_ordered:
+            objects.append(subobj)
+            parents.append(idx)
+            levels.append(levels[idx]+1)
+
+      self.objects = objects
+      self.parent = np.array(parents, dtype=int)
+      self.level = np.array(levels, dtype=int)
+      self.size_mm = np.array([obj.size_mm for obj in objects], dtype=float)
+      self.offs_mm = np.array([obj.offs_mm for obj in objects], dtype=float)
+      self.align = np.array([[self.align_codes[idx][obj.align[idx]] for idx in range(2)] for obj in objects], dtype=int)
+      self.margin_mm = np.array([obj.margin_mm for obj in objects], dtype=float)
+      self.mm_coef = np.array([obj.mm_coef for obj in objects], dtype=float)
+
+      self.level_idxs = [np.flatnonzero(self.level == level) for level in range(self.level.max()+1)]
+########################################
+   @property
+   def ObjectsCount(self):
+      return len(self.objects)
+
+   @property
+   def DepthsCount(self):
+      return len(self.level_idxs)
+########################################
+   ## Shifts by overflows on the left (top) and on the right (bottom)
+   ## according to alignments (see 'alignedOverflow_mm' in 'CFigObject')
+   @staticmethod
+   def alignedOverflow_mm(align, overflow, end_overflow):
+      return np.choose(align, [overflow, -end_overflow, (overflow-end_overflow)/2])
+
+   ## Bottom-up pass: size of group is its core fitting cores of its subobjects
+   ## and its overflows fitting their parts sticking out of the core
+   ## (see 'evalGroupExtent' in 'CFigObject');
+   ## returns also the overflows and offsets moved by them (see 'GroupOffs_mm')
+   def evalSize_mm(self):
+      is_group = self.size_mm == 0
+      ## Groups without subobjects consist of their margins only
+      size = np.where(is_group, 2*self.margin_mm[:,None], self.size_mm)
+      overflow = np.zeros((self.ObjectsCount, 2))
+      end_overflow = np.zeros((self.ObjectsCount, 2))
+      offs = self.offs_mm.copy()
+      for level in range(self.DepthsCount-1, 0, -1):
+         idxs = self.level_idxs[level]
+         par = self.parent[idxs]
+         align = self.align[idxs]
+         obj_offs = self.offs_mm[idxs]
+         obj_core = size[idxs]-overflow[idxs]-end_overflow[idxs]
+         offs[idxs] = obj_offs-self.alignedOverflow_mm(align, overflow[idxs], end_overflow[idxs])
+         group_core = np.zeros((self.ObjectsCount, 2))
+         np.maximum.at(group_core, par, np.choose(align, [
+            obj_offs+obj_core,
+            obj_core-obj_offs,
+            obj_core+2*np.abs(obj_offs),
+         ]))
+         ## Begins of cores of subobjects within cores of their groups
+         obj_begin = np.choose(align, [
+            obj_offs,
+            group_core[par]+obj_offs-obj_core,
+            (group_core[par]-obj_core)/2.0+obj_offs,
+         ])
+         group_overflow = np.zeros((self.ObjectsCount, 2))
+         np.maximum.at(group_overflow, par, overflow[idxs]-obj_begin)
+         group_end_overflow = np.zeros((self.ObjectsCount, 2))
+         np.maximum.at(group_end_overflow, par, obj_begin+obj_core+end_overflow[idxs]-group_core[par])
+         group_size = group_overflow+group_core+group_end_overflow+2*self.margin_mm[:,None]
+         par_idxs = self.level_idxs[level-1]
+         par_is_group = is_group[par_idxs]
+         size[par_idxs] = np.where(par_is_group, group_size[par_idxs], size[par_idxs])
+         overflow[par_idxs] = np.where(par_is_group, group_overflow[par_idxs], 0)
+         end_overflow[par_idxs] = np.where(par_is_group, group_end_overflow[par_idxs], 0)
+      return size, overflow, end_overflow, offs
+
+   ## Independent on levels: it depends only on parent's size
+   ## (see 'evalRelBegin_mm' in 'CFigObject')
+   def evalRelBegin_mm(self, size, overflow, end_overflow, offs):
+      rel_begin = np.zeros((self.ObjectsCount, 2))
+      idxs = np.flatnonzero(self.parent >= 0)
+      par = self.parent[idxs]
+      par_begin = self.margin_mm[par][:,None]
+      par_end = size[par]-par_begin
+      par_size = size[par]-2*par_begin
+      obj_size = size[idxs]
+      align = self.align[idxs]
+      rel_begin[idxs] = offs[idxs] + self.alignedOverflow_mm(align, overflow[par], end_overflow[par]) + np.choose(align, [
+         par_begin,
+         par_end-obj_size,
+         par_begin+(par_size-obj_size)/2,
+      ])
+      return rel_begin
+
+   ## Top-down pass
+   def evalAbsBegin_mm(self, rel_begin):
+      abs_begin = np.zeros((self.ObjectsCount, 2))
+      for idxs in self.level_idxs[1:]:
+         abs_begin[idxs] = rel_begin[idxs]+abs_begin[self.parent[idxs]]
+      return abs_begin
+
+   def mm_to_px(self, vals_mm):
+      return np.trunc(vals_mm*self.mm_coef[:,None]).astype(int)
+########################################
+   ## Evaluates geometry of all objects
+   ## and stores it into their geometry caches
+   def Eval(self):
+      size, overflow, end_overflow, offs = self.evalSize_mm()
+      rel_begin = self.evalRelBegin_mm(size, overflow, end_overflow, offs)
+      abs_begin = self.evalAbsBegin_mm(rel_begin)
+      rel_end = rel_begin+size
+      abs_end = abs_begin+size
+
+      geometry = {
+         'size_mm': size,
+         'rel_begin_mm': rel_begin,
+         'abs_begin_mm': abs_begin,
+         'rel_end_mm': rel_end,
+         'abs_end_mm': abs_end,
+      }
+      for key in geometry.keys():
+         geometry[key[:-len('mm')]+'px'] = self.mm_to_px(geometry[key])
+      geometry = dict((key, geometry[key].tolist()) for key in geometry)
+
+      for idx, obj in enumerate(self.objects):
+         obj.ClearGeometryCache()
+         for key in geometry:
+            ## Relative position of object without parent is not defined
+            if self.parent[idx] < 0 and key.startswith('rel_'):
+               continue
+            obj.SetCachedGeometry(key, geometry[key][idx])
+################################################################################
+
+################################################################################
+################################################################################
+
+if __name__ == "__main__":
+   import figure as fig
+
+   print "<<CFigureGeometry tests>>\n"
+
+   x = fig.CFigure(300, height_mm=80, width_mm=58)
+   x.Set()
+   x.DoLayout()
+   group = x.layout.AddObjectGroupToLayout('test', x.front, xalign='center', yalign='bottom')
+   x.layout.AddObjectToGroup('obj', group, width_mm=10, height_mm=20, xoffs_mm=10, xloc='rightof')
+   x.layout.AddObjectToGroup('obj', group, width_mm=20, height_mm=30, xloc='rightof')
+   x.layout.AddObjectToLayout(parent=x.back, key='test', height_mm=8, width_mm=12, yalign='center', xalign='right', xoffs_mm=1, margin_mm=1)
+
+   geometry = CFigureGeometry(x)
+   geometry.Eval()
+   vectorized = [(str(obj), obj.Size_px, obj.AbsBegin_px, obj.AbsEnd_mm) for obj in geometry.objects]
+   for obj in geometry.objects:
+      obj.ClearGeometryCache()
+   scalar = [(str(obj), obj.Size_px, obj.AbsBegin_px, obj.AbsEnd_mm) for obj in geometry.objects]
+
+   for v, s in zip(vectorized, scalar):
+      print v, "OK" if v == s else "MISMATCH: "+str(s)
+
+   print "\n<</CFigureGeometry tests>>"
+
+################################################################################
+################################################################################
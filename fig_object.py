@@ -7,6 +7,7 @@ from __future__ import division
 from collections import defaultdict
 from operator import add, getitem
 from functools import reduce  ## forward compatibility for Python 3
+from functools import wraps
 
 import copy as cp
 import inspect
@@ -21,9 +22,6 @@ log.basicConfig(stream=sys.stdout, level=log.WARNING)
 
 DEFAULT = object()
 
-class CDummy:
-   pass
-
 f_None = lambda *args,**kwargs:None
 f_True = lambda *args,**kwargs:True
 
@@ -58,32 +56,145 @@ def str_title(str_, isep="_", osep=""):
 ################################################################################
 ################################################################################
 
+class CFrozenDict(dict):
+   """
+   Immutable dictionary.
+   Merges of frozen dictionaries are frozen as well,
+   so they can be shared between merge results
+   instead of being copied.
+   Nested dictionaries are expected to be frozen too
+   (see 'freeze_dict').
+   """
+########################################
+   def immutable(self, *args, **kwargs):
+      raise TypeError("'%s' object is immutable" % self.__class__.__name__)
+
+   __setitem__ = __delitem__ = immutable
+   clear = pop = popitem = setdefault = update = immutable
+########################################
+   def __reduce__(self):
+      return (self.__class__, (dict(self),))
+
+   def __copy__(self):
+      return self
+
+   def __deepcopy__(self, memo):
+      return self
+
+def is_frozen_dict(d):
+   return isinstance(d, CFrozenDict)
+
+def freeze_dict(d):
+   if not is_dict(d) or is_frozen_dict(d):
+      return d
+   return CFrozenDict((key, freeze_dict(d[key])) for key in d)
+
+## Copy of mutable dictionaries and lists (with their nested values),
+## frozen dictionaries and other values are shared
+def copy_mutable(value):
+   type_ = type(value)
+   if type_ is dict:
+      value = dict(value)
+      for key, val in value.iteritems():
+         if isinstance(val, (dict, list)) and not is_frozen_dict(val):
+            value[key] = copy_mutable(val)
+      return value
+   if type_ is list:
+      return [copy_mutable(val) for val in value]
+   if is_frozen_dict(value) or not isinstance(value, (dict, list)):
+      return value
+   return cp.deepcopy(value)
+
+## Hashable equivalent of (nested) dictionaries, lists and tuples,
+## e.g. to be used as a key of attributes.
+## Equal values differ if their types differ (e.g. '1', '1.0' and 'True'),
+## as they differ when formatted, floats differ by their representation
+## (e.g. '0.0' and '-0.0').
+## Raises 'TypeError' for unhashable values.
+def hashable_value(value):
+   if is_dict(value):
+      return (dict, tuple(sorted((hashable_value(key), hashable_value(value[key])) for key in value)))
+   if isinstance(value, (list, tuple)):
+      return (type(value), tuple(hashable_value(val) for val in value))
+   hash(value)
+   return (type(value), value if not isinstance(value, float) else repr(value))
+
+## Results of merges of frozen dictionaries (keyed by their 'id's,
+## inputs are kept to keep the 'id's valid)
+merge_frozen_dicts_memo = {}
+merge_frozen_dicts_memo_size = 4096
+
 ## 'dict2' takes precedence
 ## Inputs don't have to be dictionaries,
-## but can be also single values
+## but can be also single values.
+## Merge of two frozen dictionaries is frozen: it shares unchanged items
+## with the inputs and it is memoized.
+## Otherwise the result is a new mutable dictionary, mutable values
+## of inputs are copied (frozen ones are still shared).
 def merge_2dicts_rec(dict1, dict2):
    if not (is_dict(dict1) and is_dict(dict2)):
+      return copy_mutable(dict2) if isinstance(dict2, (dict, list)) else dict2
+
+   if not (is_frozen_dict(dict1) and is_frozen_dict(dict2)):
+      d = dict(dict1) if is_frozen_dict(dict1) else copy_mutable(dict1)
+      merge_dict_into(d, dict2)
+      return d
+
+   if not dict2 or dict1 is dict2:
+      return dict1
+   if not dict1:
       return dict2
+   memo_key = (id(dict1), id(dict2))
+   if memo_key in merge_frozen_dicts_memo:
+      return merge_frozen_dicts_memo[memo_key][2]
+
+   d = dict(dict1)
+   merge_dict_into(d, dict2)
+   ## Only whole frozen results are shared
+   ## (nested dictionaries of inputs might have not been frozen)
+   if any(is_dict(val) and not is_frozen_dict(val) for val in d.itervalues()):
+      return d
+   d = CFrozenDict(d)
+
+   if len(merge_frozen_dicts_memo) >= merge_frozen_dicts_memo_size:
+      merge_frozen_dicts_memo.clear()
+   merge_frozen_dicts_memo[memo_key] = (dict1, dict2, d)
+   return d
 
-   d = dict1.copy()
+## Only changed keys of 'd' are touched
+def merge_dict_into(d, dict2):
+   frozen2 = is_frozen_dict(dict2)
    for key in dict2:
       if key not in d:
-         d[key] = dict2[key]
+         val = dict2[key]
+         d[key] = val if frozen2 or not isinstance(val, (dict, list)) else copy_mutable(val)
       else:
          d[key] = merge_2dicts_rec(d[key], dict2[key])
-   return d
 
 ## The last of 'dicts' takes the highest precedence
 ## Inputs don't have to be dictionaries
-## but can be also single values
+## but can be also single values.
+## Resulting dictionary is a new mutable one, it is copied only once.
+## Its nested dictionaries are mutable copies too,
+## unless they are merged only from frozen ones.
 def merge_dicts(*dicts):
-   log.log(1, "MERGE inputs:")
-   for d in dicts:
-      log.log(1, str(d))
+   if log.getLogger().isEnabledFor(1):
+      log.log(1, "MERGE inputs:")
+      for d in dicts:
+         log.log(1, str(d))
    d0 = dicts[0]
+   copied = False
    for d in dicts[1:]:
-      d0 = merge_2dicts_rec(d0,d)
-   log.log(1, "MERGE output: "+str(d0))
+      if not (is_dict(d0) and is_dict(d)):
+         d0 = d
+         copied = False
+         continue
+      if not copied:
+         d0 = dict(d0) if is_frozen_dict(d0) else copy_mutable(d0)
+         copied = True
+      merge_dict_into(d0, d)
+   if log.getLogger().isEnabledFor(1):
+      log.log(1, "MERGE output: "+str(d0))
    return d0
 
 def merge_lists(*lists):
@@ -99,6 +210,83 @@ def dict_set_nested(dict_, keys, value):
    dict_get_nested(dict_, keys[:-1])[keys[-1]] = value
    return dict_
 
+## Tuples are immutable, returns modified copy
+def tuple_set(tuple_, idx, value):
+   return tuple_[:idx]+(value,)+tuple_[idx+1:]
+
+## Decorator of 'CCompositionBase' methods
+## that replaces arguments with value of 'DEFAULT' object
+## by corresponding default value of the object
+## before the method is called
+## -> nearly like from 'GetAttrDefault',
+## but also altered by input arguments when constructing objects
+## (their keywords are prefixed by the prefix and "_",
+## see 'getFunctionAttrDefault').
+## '**keywords' are merged with object (not class) defaults implicitly ('merge_keywords'),
+## whereas '**keywords' takes precedence over defaults.
+## 'prefix' is a name of the argument that holds the prefix,
+## or a function of the dictionary of bound arguments that returns it.
+## Signature of the method is inspected only once
+## and names of default attributes are cached per class and prefix.
+def attr_defaults_args(prefix=None, args_offset=1, merge_keywords=True):
+   if prefix == None:
+      prefix_f = lambda args: ""
+   elif is_str(prefix):
+      prefix_f = lambda args: args[prefix]
+   else:
+      prefix_f = prefix
+
+   def decorator(f):
+      argspec = inspect.getargspec(f)
+      ## Without 'self'
+      arg_keys = argspec.args[1:]
+      arg_keys_set = set(arg_keys)
+      defaults = argspec.defaults or ()
+      arg_defaults = dict(zip(arg_keys[len(arg_keys)-len(defaults):], defaults))
+      bound_keys = argspec.args[args_offset:]
+      keywords_key = argspec.keywords if merge_keywords else None
+      if keywords_key != None:
+         bound_keys = bound_keys+[keywords_key]
+      tables = {}
+
+      @wraps(f)
+      def wrapper(self, *args, **keywords):
+         if len(args) > len(arg_keys):
+            raise TypeError("%s() takes at most %d arguments (%d given)" % (f.__name__, len(arg_keys)+1, len(args)+1))
+         args_ = dict(zip(arg_keys, args))
+         extra_keywords = {}
+         for key in keywords:
+            if key in args_:
+               raise TypeError("%s() got multiple values for keyword argument '%s'" % (f.__name__, key))
+            if key in arg_keys_set:
+               args_[key] = keywords[key]
+            else:
+               extra_keywords[key] = keywords[key]
+         for key in arg_keys:
+            if key not in args_:
+               if key not in arg_defaults:
+                  raise TypeError("%s() takes argument '%s'" % (f.__name__, key))
+               args_[key] = arg_defaults[key]
+         if keywords_key != None:
+            args_[keywords_key] = extra_keywords
+
+         prefix_ = prefix_f(args_)
+         table_key = (self.__class__, prefix_)
+         if table_key not in tables:
+            tables[table_key] = self.__class__.functionAttrDefaultsTable(prefix_, bound_keys)
+         for arg_key, default_arg_key, class_attr_key in tables[table_key]:
+            if arg_key == keywords_key:
+               args_[arg_key] = merge_dicts(self.getFunctionAttrDefault(default_arg_key, arg_key, class_attr_key, {}), args_[arg_key])
+            elif args_[arg_key] is DEFAULT:
+               args_[arg_key] = self.getFunctionAttrDefault(default_arg_key, arg_key, class_attr_key)
+
+         if keywords_key != None:
+            extra_keywords = args_.pop(keywords_key)
+         args_.update(extra_keywords)
+         return f(self, **args_)
+      return wrapper
+   return decorator
+
 ################################################################################
 ################################################################################
 
@@ -109,15 +297,39 @@ class CCompositionBase(object):
    Dummy base class that defines basic routines
    of composition objects
    """
+########################################
+   ## Subclasses without '__slots__' still have '__dict__',
+   ## which is necessary for attributes set in 'SetAttrs'
+   __slots__ = ('ptr', 'attrs')
 ########################################
    def __init__(self, ptr, **args):
       self.SetPtr(ptr)        #<- Pointer to composed object
-      self.attrs = {}         #<- Contains all optional attributes
-      self.args = None        #<- See 'SetFunctionAttrDefaults'
-      self.args_stack = []    #<- Backups previous arguments
+      self.attrs = {}         #<- Contains overridden optional attributes
       self.SetAttrs(args)
 ########################################
+   ## Attributes are layered: class defaults ('attr_defaults')
+   ## are resolved lazily here, only if the object does not override them
+   ## (overridden attributes are set directly in the object in 'SetAttrs'
+   ## or at runtime), then composed object is searched.
+   ## Objects that do not set overridden attributes as members
+   ## ('attrs_as_members') resolve them here from 'attrs' too,
+   ## so all reads of their attributes come here
+   ## and they can be recorded into set 'attrs_read', if it is set.
+   attrs_as_members = True
+   attrs_read = None
+
    def __getattr__(self, attr_key):
+      attrs_read = self.attrs_read
+      if attrs_read != None:
+         attrs_read.add(attr_key)
+      if not self.attrs_as_members:
+         ## Not through '__getattr__' if it is not set yet
+         attrs = CCompositionBase.attrs.__get__(self)
+         if attr_key in attrs:
+            return attrs[attr_key]
+      attr_defaults = self.__class__.attrDefaults()
+      if attr_key in attr_defaults:
+         return attr_defaults[attr_key]
       return getattr(self.ptr, attr_key)
 ########################################
    def __copy__(self):
@@ -134,6 +346,9 @@ class CCompositionBase(object):
    
    @classmethod
    def attrDefaults(cls):
+      ## Freeze once, so that defaults can be shared
+      if not is_frozen_dict(cls.attr_defaults):
+         cls.attr_defaults = freeze_dict(cls.attr_defaults)
       return cls.attr_defaults
 
    @classmethod
@@ -153,67 +368,45 @@ class CCompositionBase(object):
          return self.GetAttrDefault(attr_key) if attr_key not in self.attrs else self.attrs[attr_key]
 
    ## Override this only to set attributes from '**self.attrs' differently
+   ## Default values are not copied into the object
+   ## (see '__getattr__'), so only overridden attributes are set here
+   ## (merged with their default values)
    def SetAttrs(self, attrs=None, out_attrs_key='attrs'):
       if attrs == None:
          attrs = self.attrs
-      ## Implicit set of attributes according to default values:
-      for attr_key in self.AttrDefaults().keys():
-         if attr_key not in attrs:
-            attrs[attr_key] = self.GetAttrDefault(attr_key)
-         else:
-            attrs[attr_key] = merge_dicts(self.GetAttrDefault(attr_key), attrs[attr_key])
+      attr_defaults = self.AttrDefaults()
       for attr_key in attrs.keys():
-         if is_str(attr_key):
+         if attr_key in attr_defaults:
+            attrs[attr_key] = merge_dicts(attr_defaults[attr_key], attrs[attr_key])
+         if is_str(attr_key) and self.attrs_as_members:
             setattr(self, attr_key, attrs[attr_key])
       setattr(self, out_attrs_key, merge_dicts(getattr(self, out_attrs_key), attrs))
 
-   ## In method definition in child classes,
-   ## use this routine to set all method arguments
-   ## with value of 'DEFAULT' object
-   ## to its correspoding default value of object
-   ## -> nearly like from 'GetAttrDefault',
-   ## but also altered by input arguments when constructing objects.
-   ## (It's keyword is prefixed by 'attr_default_prefix_str'+"_").
-   ## However, one have to access these updated arguments
-   ## through 'args' object, not directly.
-   ## '**keywords' are merged with object (not class) defaults implicitly ('merge_keywords'),
-   ## whereas '**keywords' takes precedence over defaults.
-   def SetFunctionAttrDefaults(self, attr_default_prefix="", args_offset=1, merge_keywords=True):
-      def _prefix():
-         return "" if attr_default_prefix == "" else attr_default_prefix+"_"
-
-      argvalues = inspect.getargvalues(sys._getframe(1))
-      ## We want to iterate only through function arguments
-      ## starting from 'args_offset' (ommit first arguments)
-      args_ = argvalues.args[args_offset:]
-      ## .. but locals contain their values
-      locals_ = argvalues.locals
-      
-      ## Initialize arguments
-      self.args_stack.append(self.args)
-      self.args = CDummy()
-      for arg_key in args_:
-         default_arg_key = _prefix()+arg_key
-         setattr(self.args, arg_key, (
-            locals_[arg_key] if locals_[arg_key] != DEFAULT
-            else getattr(self, default_arg_key) if hasattr(self, default_arg_key)
-            else getattr(self, arg_key) if hasattr(self, arg_key)
-            else None
-         ))
-      keywords_ = argvalues.keywords
-      if merge_keywords and keywords_ != None:
-         default_keywords = _prefix()+keywords_
-         setattr(self.args, keywords_, merge_dicts((
-               getattr(self, default_keywords) if hasattr(self, default_keywords)
-               else getattr(self, keywords_) if hasattr(self, keywords_)
-               else {}
-            ), locals_[keywords_]
-         ))
-      ## You better call 'CleanFunctionAttrDefaults' after use of 'self.args'
-
-   ## Call this at the end of each function where you call 'SetFunctionAttrDefaults'
-   def CleanFunctionAttrDefaults(self):
-      self.args = self.args_stack.pop()
+   ## Lookup table for 'attr_defaults_args':
+   ## argument key, prefixed argument key and the prefixed key again
+   ## if it is certainly present in all objects of the class
+   ## (because of 'attr_defaults'), otherwise 'None'
+   @classmethod
+   def functionAttrDefaultsTable(cls, attr_default_prefix, arg_keys):
+      prefix = "" if attr_default_prefix == "" else attr_default_prefix+"_"
+      attr_defaults = cls.attrDefaults()
+      table = []
+      for arg_key in arg_keys:
+         default_arg_key = prefix+arg_key
+         class_attr_key = default_arg_key if default_arg_key in attr_defaults else None
+         table.append((arg_key, default_arg_key, class_attr_key))
+      return table
+
+   ## Prefixed key is searched first, in the object and then
+   ## in composed objects (see '__getattr__'), then the key itself
+   def getFunctionAttrDefault(self, default_arg_key, arg_key, class_attr_key=None, none_value=None):
+      if class_attr_key != None:
+         return getattr(self, class_attr_key)
+      if hasattr(self, default_arg_key):
+         return getattr(self, default_arg_key)
+      if hasattr(self, arg_key):
+         return getattr(self, arg_key)
+      return none_value
 ########################################
    ## Filter certain items from 'attrs'
    ## and sort them.
@@ -226,16 +419,19 @@ class CCompositionBase(object):
    ## rank system can be used,
    ## i.e. the less is the item's rank,
    ## the higher priority it has.
+   ## Default values that are not overridden are filtered too.
    def ItemsFromAttrs(self, select_key_f, sort_f=f_None, select_value_f=f_True):
       attrs = self.attrs
-      attrs_copy = attrs.copy()
+      attrs_copy = dict(self.AttrDefaults())
+      attrs_copy.update(attrs)
       items = []
       for attr_key in attrs_copy:
          if select_key_f(attr_key):
-            attr = attrs[attr_key]
+            attr = attrs_copy[attr_key]
             if select_value_f(attr):
                items.append((attr_key,attr))
-            del attrs[attr_key]
+            if attr_key in attrs:
+               del attrs[attr_key]
       items.sort(key=sort_f)
       return items
 
@@ -255,6 +451,8 @@ class CDrawEffect(object):
    """
    Class with user defined function and its arguments.
    """
+########################################
+   __slots__ = ('draw', 'key', 'type', 'attrs', 'function')
 ########################################
    def __init__(self, draw, effect_key, type_='', **args):
       self.draw = draw
@@ -263,8 +461,12 @@ class CDrawEffect(object):
       self.attrs = {}
       self.SetAttrs(**args)
 ########################################
+   ## Effect function is bound once per type
+   ## (see 'EffectFunction' in 'CDrawObjectBase')
    def SetType(self, type_=''):
       self.type = type_
+      self.function = self.draw.EffectFunction(self.key, type_)
+      self.draw.setObjectDrawDirty()
 
    def SetAttrs(self, **args):
       if 'type' in args:
@@ -272,16 +474,16 @@ class CDrawEffect(object):
          del args['type']
 
       self.attrs = merge_dicts(self.attrs, args)
+      self.draw.setObjectDrawDirty()
 ########################################
-   ## 'f_key' is an 'DrawObject...' method
+   ## 'function' is an 'DrawObject...' method
    ## Pass dummy keywords in method's parameters
    ## as this object can contain additional attributes
    ## due to merge from arguments (see 'SeeAttrs' in 'CCompositionBase')
    ## with different effect type
    def Apply(self):
-      f_key = 'Effect'+str_title(self.key)+str_title(self.type)
-      if hasattr(self.draw, f_key):
-         getattr(self.draw, f_key)(**self.attrs)
+      if self.function != None:
+         self.function(**self.attrs)
 ################################################################################
 
 ################################################################################
@@ -290,6 +492,25 @@ class CDrawObjectBase(CCompositionBase):
    Dummy draw object base class that defines interface
    between 'CFigObject' and 'CDrawObject..' objects
    """
+########################################
+   ## '__dict__' holds attributes set in 'SetAttrs'
+   ## and draw tool specific attributes
+   __slots__ = (
+      'shared_draw_attrs_create', 'local_draw_attrs_create',
+      'shared_draw_attrs', 'local_draw_attrs',
+      'effects', 'effects_ordered',
+      '__dict__',
+   )
+
+   ## Set in draw tools that keep drawn objects (e.g. layers) between draws,
+   ## so that only objects with dirty draw are drawn again
+   ## (see 'Draw' in 'CFigObject')
+   redraw_dirty_only = False
+
+   ## Unset in draw tools that do not apply effects at all,
+   ## otherwise effects without their methods are reported as warnings
+   ## (see 'effectFunctionKey')
+   warn_unknown_effects = True
 ########################################
    ## Do not override contructor
    ## More attributes are possible to set through '**args',
@@ -310,6 +531,7 @@ class CDrawObjectBase(CCompositionBase):
    def ClearEffect(self, effect_key):
       if effect_key not in self.effects:
          return
+      self.setObjectDrawDirty()
       del self.effects[effect_key]
       for idx in range(len(self.effects_ordered)):
          if self.effects_ordered[idx].key == effect_key:
@@ -359,10 +581,69 @@ class CDrawObjectBase(CCompositionBase):
 ########################################
    ## Do not override this
    def SetAttrs(self, attrs=None):
-      CCompositionBase.SetAttrs(self, self.sharedDrawObjectAttrs(), 'shared_draw_attrs')
-      CCompositionBase.SetAttrs(self, self.localDrawObjectAttrs(), 'local_draw_attrs')
+      self.SetDrawAttrs()
       CCompositionBase.SetAttrs(self, attrs)
       self.AddEffectsFromAttrs()
+      self.setObjectDrawDirty()
+
+   ## Any change of attributes or effects makes draw of the object dirty
+   ## (see 'SetDrawDirty' in 'CFigObject')
+   def setObjectDrawDirty(self):
+      self.ptr.SetDrawDirty()
+
+   ## Do not override this
+   ## Only shared and local draw attributes depend on the root object,
+   ## so only they need to be set again when the object is moved
+   ## (own attributes still take precedence)
+   def SetDrawAttrs(self):
+      CCompositionBase.SetAttrs(self, self.sharedDrawObjectAttrs(), 'shared_draw_attrs')
+      CCompositionBase.SetAttrs(self, self.localDrawObjectAttrs(), 'local_draw_attrs')
+      for attr_key in self.shared_draw_attrs.keys()+self.local_draw_attrs.keys():
+         if attr_key in self.attrs:
+            setattr(self, attr_key, self.attrs[attr_key])
+
+   ## Do not override this
+   ## Returns draw object for 'object_' (a copy of this object's figure object)
+   ## with copies of already evaluated attributes of this one (the prototype),
+   ## so that attributes and effects are not evaluated from scratch
+   def CloneForObject(self, object_):
+      return self.__class__.fromDrawState(object_, self.DrawState())
+
+   ## Do not override this
+   ## Evaluated attributes and effects of the object,
+   ## without draw attributes (they depend on the root object)
+   def DrawState(self):
+      draw_attr_keys = set(self.shared_draw_attrs.keys()+self.local_draw_attrs.keys())
+      return (
+         dict((attr_key, attr) for attr_key, attr in self.__dict__.items() if attr_key not in draw_attr_keys),
+         dict(self.attrs),
+         [(effect.key, effect.type, dict(effect.attrs)) for effect in sorted(self.effects_ordered, key=lambda eff: self.GetEffectRank(eff.key))],
+      )
+
+   ## Do not override this
+   ## The state can be used repeatedly
+   @classmethod
+   def fromDrawState(cls, object_, state):
+      dict_, attrs, effects = state
+      draw = cls.__new__(cls)
+      draw.__dict__.update(dict_)
+      draw.ptr = object_
+      ## Mutable attributes are not shared with the prototype,
+      ## members refer to the copies as after 'SetAttrs'
+      draw.attrs = copy_mutable(attrs)
+      for attr_key in draw.attrs:
+         if attr_key in dict_:
+            draw.__dict__[attr_key] = draw.attrs[attr_key]
+      draw.shared_draw_attrs_create = False
+      draw.local_draw_attrs_create = False
+      draw.shared_draw_attrs = {}
+      draw.local_draw_attrs = {}
+      draw.ClearEffects()
+      for effect_key, effect_type, effect_attrs in effects:
+         draw.effects_ordered.append(CDrawEffect(draw, effect_key, effect_type, **effect_attrs))
+         draw.effects[effect_key] = draw.effects_ordered[-1]
+      draw.SetDrawAttrs()
+      return draw
 
    ## Do not override this
    def sharedDrawObjectAttrs(self):
@@ -380,13 +661,13 @@ class CDrawObjectBase(CCompositionBase):
       self.shared_draw_attrs = self.CreateSharedDrawObjectAttrs()
       ## Invalidate local attributes
       self.cleanLocalDrawObjectAttrs()
-      log.info("create shared: " + str(self.ptr) + " " + str(self.shared_draw_attrs))
+      log.info("create shared: %s %s", self.ptr, self.shared_draw_attrs)
    
    ## Do not override this
    def cleanSharedDrawObjectAttrs(self, force=False):
       if not force and not self.shared_draw_attrs_create:
          return
-      log.info("clean shared: " + str(self.ptr) + " " + str(self.shared_draw_attrs))
+      log.info("clean shared: %s %s", self.ptr, self.shared_draw_attrs)
       self.CleanSharedDrawObjectAttrs()
       self.shared_draw_attrs_create = False
 
@@ -407,7 +688,7 @@ class CDrawObjectBase(CCompositionBase):
       self.shared_draw_attrs = self.RootObject.draw.shared_draw_attrs
       ## Invalidate local attributes
       self.cleanLocalDrawObjectAttrs()
-      log.info("link shared: " + str(self.ptr) + " " + str(self.shared_draw_attrs))
+      log.info("link shared: %s %s", self.ptr, self.shared_draw_attrs)
 
    ## Do not override this
    def localDrawObjectAttrs(self):
@@ -420,13 +701,13 @@ class CDrawObjectBase(CCompositionBase):
          return
       self.local_draw_attrs_create = True
       self.local_draw_attrs = self.CreateLocalDrawObjectAttrs()
-      log.info("create local: " + str(self.ptr) + " " + str(self.local_draw_attrs))
+      log.info("create local: %s %s", self.ptr, self.local_draw_attrs)
 
    ## Do not override this
    def cleanLocalDrawObjectAttrs(self, force=False):
       if not force and not self.local_draw_attrs_create:
          return
-      log.info("clean local: " + str(self.ptr) + " " + str(self.local_draw_attrs))
+      log.info("clean local: %s %s", self.ptr, self.local_draw_attrs)
       self.CleanLocalDrawObjectAttrs()
       self.local_draw_attrs_create = False
 
@@ -478,6 +759,8 @@ class CDrawObjectBase(CCompositionBase):
 
    @classmethod
    def effectsAttrDefaults(cls):
+      if not is_frozen_dict(cls.effects_attr_defaults):
+         cls.effects_attr_defaults = freeze_dict(cls.effects_attr_defaults)
       return cls.effects_attr_defaults
 
    @classmethod
@@ -510,6 +793,31 @@ class CDrawObjectBase(CCompositionBase):
 
    def GetEffectRank(self, effect_key):
       return self.__class__.getEffectRank(effect_key)
+########################################
+   ## Dispatch table of names of effect methods
+   ## ('Effect'+effect key+effect type),
+   ## it is filled once per class and pair of effect key and type.
+   ## Unknown effects are reported only once and map to 'None'
+   ## (see 'warn_unknown_effects')
+   @classmethod
+   def effectFunctionKey(cls, effect_key, effect_type):
+      functions = cls.__dict__.get('effect_functions_')
+      if functions == None:
+         functions = cls.effect_functions_ = {}
+      key = (effect_key, effect_type)
+      if key not in functions:
+         f_key = 'Effect'+str_title(effect_key)+str_title(effect_type)
+         if not hasattr(cls, f_key):
+            log.log(log.WARNING if cls.warn_unknown_effects else log.INFO,
+               "unknown effect: '%s' of type '%s' in %s", effect_key, effect_type, cls.__name__)
+            f_key = None
+         functions[key] = f_key
+      return functions[key]
+
+   ## Returns bound effect method or 'None'
+   def EffectFunction(self, effect_key, effect_type):
+      f_key = self.__class__.effectFunctionKey(effect_key, effect_type)
+      return None if f_key == None else getattr(self, f_key)
 ########################################
    ## Updates only effects that already exists in object
    ## from 'effects_attr_defaults' by effect key and type
@@ -561,6 +869,7 @@ class CDrawObjectBase(CCompositionBase):
    def ScaleEffectAttr(self, effect_key, attr_key, scale=1):
       if effect_key in self.effects and attr_key in self.effects[effect_key].attrs and self.effects[effect_key].attrs[attr_key]:
          self.effects[effect_key].attrs[attr_key] *= scale
+         self.setObjectDrawDirty()
 
    ## It can be necessary to scale whole object
    ## during its creation,
@@ -618,6 +927,8 @@ class CDrawObjectPrint(CDrawObjectBase):
    """
    Draw object class that only prints object and its contents
    """
+########################################
+   warn_unknown_effects = False
 ########################################
    def PreDrawRootObject(self):
       print "['%s' root figure object's draw]" % self.key
@@ -638,12 +949,23 @@ class CFigObject(object):
    I.e., one usually want to use negative offset
    for bottom/right y/x offset alignment.
    """
+########################################
+   ## There can be a lot of objects, so they are kept compact:
+   ## no '__dict__' and immutable pairs (x,y) of geometry values
+   __slots__ = (
+      'key', 'key_base', 'key_suffix', 'figure',
+      'objects', 'objects_ordered', 'objects_cnt', 'objects_by_key_base',
+      'draw',
+      'parent', 'idx', 'depth', 'root_object',
+      'geometry_cache', 'positions_cache', 'positions_used',
+      'draw_dirty', 'objects_draw_dirty',
+      'resolution_ppi', 'size_mm', 'margin_mm', 'offs_mm', 'align',
+      'opacity',
+   )
 ########################################
    ## '0' height/width means that object's size may be calculated
    ## from its subobjects -> it acts as dynamic group of objects
-   ##! Groups does not update their offsets if its subobjects left bound
-   ##! is more on left. Also, evaluation of width with right-aligned objects
-   ##! that are more on right is incorrect. (Same for y axis).
+   ## (see 'evalGroupExtent')
    def __init__(self, key='object', resolution_ppi=300,
       width_mm=0, height_mm=0,
       xalign='left', yalign='top', xoffs_mm=0, yoffs_mm=0,
@@ -653,25 +975,33 @@ class CFigObject(object):
       draw_class=CDrawObjectPrint,
       **draw_args
    ):
-      self.key = key
-      self.figure = figure
-
-      self.resolution_ppi = resolution_ppi
-      self.size_mm = [0,0]
-      self.SetSize(width_mm=width_mm, height_mm=height_mm, margin_mm=margin_mm)
+      self.draw_dirty = True
+      self.objects_draw_dirty = False
+      self.positions_used = False
 
-      self.offs_mm = [xoffs_mm, yoffs_mm]
-      self.align = [0,0]
-      self.SetAlign(xalign, 0)
-      self.SetAlign(yalign, 1)
+      self.setKey(key)
+      self.figure = figure
 
       self.objects = {}
       self.objects_ordered = []
       self.objects_cnt = 0
+      ## Subobjects with the same key base ordered by their key suffix
+      self.objects_by_key_base = {}
 
       self.draw = None
 
       self.InitParent()
+      self.ClearGeometryCache()
+
+      self.resolution_ppi = resolution_ppi
+      self.size_mm = (0,0)
+      self.SetSize(width_mm=width_mm, height_mm=height_mm, margin_mm=margin_mm)
+
+      self.offs_mm = (xoffs_mm, yoffs_mm)
+      self.align = (0,0)
+      self.SetAlign(xalign, 0)
+      self.SetAlign(yalign, 1)
+
       self.SetParent(parent)
       self.SetOpacity(opacity)
 
@@ -684,6 +1014,34 @@ class CFigObject(object):
    ## (Sometimes one wants to use completely different position.)
    ## Still, object's parent >is< copied, thus its position is eval'ed from it.
    def __copy__(self):
+      return self.copyWithParent(self.parent)
+   
+   ## Subobjects are copied top-down right into their new parents,
+   ## so that each copied object is set up only once
+   ## (its draw object is cloned, see 'SetDrawFromObject').
+   ## Copy is eager, i.e. linear in size of the subtree:
+   ## copies are inserted into figures and drawn,
+   ## which needs all their objects anyway
+   def __deepcopy__(self, memo):
+      obj = self.__copy__()
+      obj.copySubobjectsFrom(self)
+      return obj
+
+   ## Copy has size of the copied object (see 'copyWithParent'),
+   ## so it has no overflows and its subobjects are shifted
+   ## by overflows of the copied object instead (see 'evalRelBegin_mm')
+   def copySubobjectsFrom(self, object_):
+      overflows = [(0, 0) if not self.size_mm[idx] else (object_.GroupOverflow_mm(idx), object_.GroupEndOverflow_mm(idx)) for idx in range(2)]
+      for subobj in object_.objects_ordered:
+         subcopy = subobj.copyWithParent(self)
+         subcopy.SetPosFromObject(subobj,
+            add_xoffs_mm=subobj.alignedOverflow_mm(overflows[0][0], overflows[0][1], 0),
+            add_yoffs_mm=subobj.alignedOverflow_mm(overflows[1][0], overflows[1][1], 1),
+         )
+         self.InsertObject(subcopy)
+         subcopy.copySubobjectsFrom(subobj)
+
+   def copyWithParent(self, parent):
       obj = self.__class__(
          ## Key will be possibly incremented when inserting into parent object
          key               = self.ObjectKeyBase,
@@ -692,27 +1050,30 @@ class CFigObject(object):
          height_mm         = self.Height_mm,
          margin_mm         = self.Margin_mm,
          opacity           = self.Opacity,
-         parent            = self.parent,
+         parent            = parent,
          figure            = self.figure,
          draw_class        = None,
       )
       obj.SetDrawFromObject(self)
       return obj
-   
-   def __deepcopy__(self, memo):
-      obj = self.__copy__()
-      for subobj in self.objects_ordered:
-         subcopy = cp.deepcopy(subobj)
-         subcopy.SetPosFromObject(subobj)
-         obj.InsertObject(subcopy)
-      return obj
 ########################################
    def __str__(self):
       return "%s%s: %.1fx%.1f%+.1f%+.1f" % ("" if self.idx == None else "["+str(self.idx)+"] ", self.key, self.Width_mm, self.Height_mm, self.AbsBegin_mm[0], self.AbsBegin_mm[1])
 ########################################
    def SetKey(self, key):
       if key != None:
-         self.key = key
+         self.setKey(key)
+
+   ## Key base and suffix are parsed only here
+   def setKey(self, key):
+      self.key = key
+      key_split = key.rsplit("_",1)
+      if len(key_split) == 2 and str_is_int(key_split[1]):
+         self.key_base = key_split[0]
+         self.key_suffix = int(key_split[1])
+      else:
+         self.key_base = key
+         self.key_suffix = None
 
    ## 'None' values means not to modify this attribute
    ## Scale only before or after setting sizes.
@@ -723,9 +1084,10 @@ class CFigObject(object):
          width_mm = self.size_mm[0]
       if height_mm == None:
          height_mm = self.size_mm[1]
-      self.size_mm = [width_mm, height_mm]
+      self.size_mm = (width_mm, height_mm)
       if margin_mm != None:
          self.margin_mm = margin_mm
+      self.InvalidateGeometry()
       if not scale_pre:
          self.ScaleObject(scale)
 
@@ -745,6 +1107,8 @@ class CFigObject(object):
    ## 'yloc' and 'xloc' are meant relative to 'object_' or absolute according to their value
    ## - values that correspond with 'self.align' possible values are absolute
    ## - 'None' value means to keep previous align
+   ## Relative positions are given by whole objects including their overflows
+   ## (see 'GroupOffs_mm')
    def SetPosFromObject(self, object_, xloc='sameas', yloc='sameas', add_xoffs_mm=0, add_yoffs_mm=0):
       rel_locs = [['leftof','rightof','centerof'],['above','below','centerof']]
       loc = [xloc, yloc]
@@ -762,28 +1126,35 @@ class CFigObject(object):
             self.SetAlign(l, idx)
             object_offs_mult = 0
 
-         self.offs_mm[idx] = object_offs_mult*object_.offs_mm[idx]+add_offs_mm[idx] + ({
+         if object_offs_mult:
+            object_offs = object_offs_mult*object_.GroupOffs_mm(idx) + self.offs_mm[idx]-self.GroupOffs_mm(idx)
+         else:
+            object_offs = 0
+         self.offs_mm = tuple_set(self.offs_mm, idx, object_offs+add_offs_mm[idx] + ({
                None: self.offs_mm[idx],
                rel_locs[idx][0] : -self.Size_mm[idx],
                rel_locs[idx][1] : object_.Size_mm[idx],
                rel_locs[idx][2] : (object_.Size_mm[idx]-self.Size_mm[idx])/2,
-            }[l] if l not in ['mirror','sameas'] and not self.IsAlignValid(l, idx) else 0)
+            }[l] if l not in ['mirror','sameas'] and not self.IsAlignValid(l, idx) else 0))
+         self.InvalidateGeometry()
 
    ## It should scale all numeric attributes of figure object
    ## except offsets
    def ScaleObject(self, scale=1, root=True):
       if scale == 1:
          return
-      for idx in range(2):
-         self.size_mm[idx] *= scale
-         if not root:
-            self.offs_mm[idx] *= scale
+      self.size_mm = tuple(val*scale for val in self.size_mm)
+      if not root:
+         self.offs_mm = tuple(val*scale for val in self.offs_mm)
       self.margin_mm *= scale
+      self.ClearGeometryCache()
       
       self.draw.ScaleDraw(scale)
       
       for obj in self.objects_ordered:
          obj.ScaleObject(scale, root=False)
+      if root:
+         self.InvalidateGeometry()
 ########################################
    c_inch = 25.4
    c_pt = 72
@@ -814,23 +1185,188 @@ class CFigObject(object):
    def pt_to_mm(self, val_pt):
       return val_pt*(CFigObject.c_inch/CFigObject.c_pt)
 ########################################
-   def evalGroupSize(self, idx):
-      max_ = 0
+   ## Geometry is evaluated lazily and cached per object
+   ## until any mutator invalidates it.
+   ## Extents (sizes and overflows) depend only on the object's subtree,
+   ## so they are dropped only for the object itself and for its ancestors
+   ## as long as they are groups and the object is inserted in them
+   ## (their size depends on their inserted subobjects).
+   ## Positions depend on ancestors, so they are dropped in the whole subtree
+   ## of the topmost of these objects, but only where they are used
+   ## (see 'clearSubtreePositions').
+   ## Objects next to this subtree stay untouched.
+   def ClearGeometryCache(self):
+      self.geometry_cache = {}
+      self.positions_cache = {}
+
+   ## Subtrees of objects without used positions are skipped:
+   ## object has used positions if it or any of its subobjects
+   ## has cached positions or its draw is not dirty
+   ## (draw depends on positions),
+   ## all its ancestors have used positions then too.
+   ## Draws of all objects with dropped positions are dirty
+   def clearSubtreePositions(self):
+      self.positions_cache = {}
+      self.positions_used = False
+      self.draw_dirty = True
+      self.objects_draw_dirty = bool(self.objects_ordered)
       for obj in self.objects_ordered:
-         ## 'RelRight' is not used to avoid circular recursion
-         ## Avoid using positive 'xoffs_mm' with 'xalign=='right'' in group
-         ## as it does not make sense at all
-         bound_mm = obj.Size_mm[idx] + obj.offs_mm[idx]
-         max_ = max(max_, bound_mm)
-      return max_
+         if obj.positions_used:
+            obj.clearSubtreePositions()
+
+   ## If an ancestor has used positions already, all its ancestors have too
+   def setPositionsUsed(self):
+      obj = self
+      while obj != None and not obj.positions_used:
+         obj.positions_used = True
+         obj = obj.parent
+
+   def InvalidateGeometry(self):
+      obj = self
+      while True:
+         obj.ClearGeometryCache()
+         if obj.parent == None or not obj.parent.IsGroup or not obj.parent.HasObject(obj):
+            break
+         obj = obj.parent
+      obj.clearSubtreePositions()
+      obj.setAncestorsDrawDirty()
+
+   ## Returns copy of cached value so that it cannot be corrupted
+   def cachedGeometry(self, key, eval_f):
+      cache = self.geometry_cache
+      if key not in cache:
+         cache[key] = eval_f()
+      val = cache[key]
+      return list(val) if isinstance(val, list) else val
+
+   def cachedPosition(self, key, eval_f):
+      cache = self.positions_cache
+      if key not in cache:
+         cache[key] = eval_f()
+         self.setPositionsUsed()
+      val = cache[key]
+      return list(val) if isinstance(val, list) else val
+
+   extent_keys = frozenset(['group_extents', 'size_mm', 'size_px'])
+
+   ## Sets geometry evaluated elsewhere (see 'CFigureGeometry')
+   def SetCachedGeometry(self, key, val):
+      if key in self.extent_keys:
+         self.geometry_cache[key] = val
+      else:
+         self.positions_cache[key] = val
+         self.setPositionsUsed()
+
+   ## Evaluates geometry of the object and all its subobjects
+   ## in one bottom-up pass (extents of groups) and one top-down pass
+   ## (positions) without recursion, which fills geometry caches,
+   ## so that only values not cached yet are evaluated
+   def SolveGeometry(self):
+      objects = [self]
+      for obj in objects:
+         objects.extend(obj.objects_ordered)
+      for obj in reversed(objects):
+         obj.Size_mm
+      for obj in objects:
+         obj.AbsBegin_mm
+         obj.AbsEnd_mm
+########################################
+   aligns = [['left','right','center'],['top','bottom','center']]
+
+   @property
+   def IsGroup(self):
+      return not (self.size_mm[0] and self.size_mm[1])
+
+   ## Extent of group along axis 'idx' is evaluated only from sizes,
+   ## offsets and alignments of its subobjects (not from their positions).
+   ## Group consists of the core, in which subobjects are aligned,
+   ## and of the overflows on the left (top) and on the right (bottom) of it:
+   ## the core fits cores of all subobjects (their size without overflows)
+   ## aligned with their offsets and the overflows fit all parts
+   ## of subobjects sticking out of the core
+   ## (e.g. left aligned subobject with negative offset
+   ## or right aligned one with positive offset).
+   ## So if subobject overflows the group, the group gets larger on that side
+   ## and absolute positions of cores of all its subobjects stay the same
+   ## (unless the group is a root object, which cannot move,
+   ## so all its subobjects are shifted).
+   ## Returns triple of size and the overflows on the left (top)
+   ## and on the right (bottom).
+   def evalGroupExtent(self, idx):
+      core = 0
+      for obj in self.objects_ordered:
+         obj_core = obj.GroupCore_mm(idx)
+         offs = obj.offs_mm[idx]
+         if obj.align[idx] == self.aligns[idx][0]:
+            core = max(core, offs+obj_core)
+         elif obj.align[idx] == self.aligns[idx][1]:
+            core = max(core, obj_core-offs)
+         else:
+            core = max(core, obj_core+2*abs(offs))
+      overflow = 0
+      end_overflow = 0
+      for obj in self.objects_ordered:
+         obj_core = obj.GroupCore_mm(idx)
+         obj_overflow = obj.GroupOverflow_mm(idx)
+         obj_end_overflow = obj.GroupEndOverflow_mm(idx)
+         offs = obj.offs_mm[idx]
+         ## Begin of core of subobject within the core
+         if obj.align[idx] == self.aligns[idx][0]:
+            obj_begin = offs
+         elif obj.align[idx] == self.aligns[idx][1]:
+            obj_begin = core+offs-obj_core
+         else:
+            obj_begin = (core-obj_core)/2.0+offs
+         overflow = max(overflow, obj_overflow-obj_begin)
+         end_overflow = max(end_overflow, obj_begin+obj_core+obj_end_overflow-core)
+      return (overflow + core + end_overflow + 2*self.margin_mm, overflow, end_overflow)
+
+   def evalGroupExtents(self):
+      return [(self.size_mm[idx], 0, 0) if self.size_mm[idx] else self.evalGroupExtent(idx) for idx in range(2)]
+
+   def GroupExtent(self, idx):
+      extents = self.geometry_cache.get('group_extents')
+      if extents == None:
+         extents = self.geometry_cache['group_extents'] = self.evalGroupExtents()
+      return extents[idx]
+
+   ## Overflow of subobjects on the left (top) side of group, otherwise zero
+   def GroupOverflow_mm(self, idx):
+      return self.GroupExtent(idx)[1]
+
+   ## Overflow of subobjects on the right (bottom) side of group, otherwise zero
+   def GroupEndOverflow_mm(self, idx):
+      return self.GroupExtent(idx)[2]
+
+   ## Size of object without its overflows
+   def GroupCore_mm(self, idx):
+      size, overflow, end_overflow = self.GroupExtent(idx)
+      return size-overflow-end_overflow
+
+   ## Shift of object by overflows on the left (top) and on the right (bottom)
+   ## according to its alignment: it is aligned next to them
+   def alignedOverflow_mm(self, overflow, end_overflow, idx):
+      if self.align[idx] == self.aligns[idx][0]:
+         return overflow
+      if self.align[idx] == self.aligns[idx][1]:
+         return -end_overflow
+      return (overflow-end_overflow)/2
+
+   ## Offset of object moved by its own overflows (see 'evalRelBegin_mm'),
+   ## i.e. offset of the whole object
+   def GroupOffs_mm(self, idx):
+      return self.offs_mm[idx]-self.alignedOverflow_mm(self.GroupOverflow_mm(idx), self.GroupEndOverflow_mm(idx), idx)
+
+   def evalSize_mm(self):
+      return [self.GroupExtent(idx)[0] for idx in range(2)]
 
    @property
    def Size_mm(self):
-      return [self.size_mm[idx] if self.size_mm[idx] else self.evalGroupSize(idx) for idx in range(2)]
+      return self.cachedGeometry('size_mm', self.evalSize_mm)
 
    @property
    def Size_px(self):
-      return map(self.mm_to_px, self.Size_mm)
+      return self.cachedGeometry('size_px', lambda: map(self.mm_to_px, self.Size_mm))
 
    @property
    def Width_mm(self):
@@ -853,14 +1389,15 @@ class CFigObject(object):
       return self.resolution_ppi
 ########################################
    def IsAlignValid(self, align, idx):
-      return align in [['left','right','center'],['top','bottom','center']][idx]
+      return align in self.aligns[idx]
 
    def SetAlign(self, align, idx):
       if align == None:
          return
       if not self.IsAlignValid(align, idx):
          raise ValueError("Invalid value for '%salign': \""+align+"\"" % ["x","y"][idx])
-      self.align[idx] = align
+      self.align = tuple_set(self.align, idx, align)
+      self.InvalidateGeometry()
 
    def SetOppositeAlign(self, align, idx):
       self.SetAlign(defaultdict(lambda:align,{
@@ -904,51 +1441,61 @@ class CFigObject(object):
    def CanvasSize_px(self):
       return map(self.mm_to_px, self.CanvasSize_mm)
 
-   @property
-   def RelBegin_mm(self):
+   ## Object is moved by its own overflows and by overflows of parent
+   ## (see 'evalGroupExtent'), so that cores of not overflowing subobjects
+   ## of group keep their positions
+   def evalRelBegin_mm(self):
       if self.parent == None:
          return 0
 
-      aligns = [['left','right','center'],['top','bottom','center']]
+      aligns = self.aligns
       begin = [0,0]
       for idx in range(2):
          par_begin = self.parent.CanvasBegin_mm[idx]
          par_end = self.parent.CanvasEnd_mm[idx]
          par_size = self.parent.CanvasSize_mm[idx]
-         begin[idx] = self.offs_mm[idx] + {
+         par_overflow = self.alignedOverflow_mm(self.parent.GroupOverflow_mm(idx), self.parent.GroupEndOverflow_mm(idx), idx)
+         begin[idx] = self.GroupOffs_mm(idx) + par_overflow + {
               aligns[idx][0] : par_begin,
               aligns[idx][1] : par_end-self.Size_mm[idx],
               aligns[idx][2] : par_begin+(par_size-self.Size_mm[idx])/2
             }[self.align[idx]]
       return begin
 
+   def evalAbsBegin_mm(self):
+      return [0,0] if self.parent == None else map(add, self.RelBegin_mm, self.parent.AbsBegin_mm)
+
+   @property
+   def RelBegin_mm(self):
+      return self.cachedPosition('rel_begin_mm', self.evalRelBegin_mm)
+
    @property
    def AbsBegin_mm(self):
-      return [0,0] if self.parent == None else map(add, self.RelBegin_mm, self.parent.AbsBegin_mm)
+      return self.cachedPosition('abs_begin_mm', self.evalAbsBegin_mm)
 
    @property
    def RelEnd_mm(self):
-      return map(add, self.RelBegin_mm, self.Size_mm)
+      return self.cachedPosition('rel_end_mm', lambda: map(add, self.RelBegin_mm, self.Size_mm))
 
    @property
    def AbsEnd_mm(self):
-      return map(add, self.AbsBegin_mm, self.Size_mm)
+      return self.cachedPosition('abs_end_mm', lambda: map(add, self.AbsBegin_mm, self.Size_mm))
 
    @property
    def RelBegin_px(self):
-      return map(self.mm_to_px, self.RelBegin_mm)
+      return self.cachedPosition('rel_begin_px', lambda: map(self.mm_to_px, self.RelBegin_mm))
 
    @property
    def AbsBegin_px(self):
-      return map(self.mm_to_px, self.AbsBegin_mm)
+      return self.cachedPosition('abs_begin_px', lambda: map(self.mm_to_px, self.AbsBegin_mm))
 
    @property
    def RelEnd_px(self):
-      return map(self.mm_to_px, self.RelEnd_mm)
+      return self.cachedPosition('rel_end_px', lambda: map(self.mm_to_px, self.RelEnd_mm))
 
    @property
    def AbsEnd_px(self):
-      return map(self.mm_to_px, self.AbsEnd_mm)
+      return self.cachedPosition('abs_end_px', lambda: map(self.mm_to_px, self.AbsEnd_mm))
 ########################################
    @property
    def Opacity(self):
@@ -957,6 +1504,35 @@ class CFigObject(object):
    def SetOpacity(self, opacity=100):
       if opacity != None:
          self.opacity = opacity
+         self.SetDrawDirty()
+########################################
+   ## Object needs to be drawn again since its last draw
+   ## if it or any of its subobjects have changed:
+   ## its draw is dirty and its ancestors are notified
+   def SetDrawDirty(self):
+      self.draw_dirty = True
+      self.setAncestorsDrawDirty()
+
+   ## If an ancestor is already notified, all its ancestors are too
+   def setAncestorsDrawDirty(self):
+      obj = self.parent
+      while obj != None and not obj.objects_draw_dirty:
+         obj.objects_draw_dirty = True
+         obj = obj.parent
+
+   @property
+   def IsDrawDirty(self):
+      return self.draw_dirty or self.objects_draw_dirty
+
+   ## Object and all its subobjects are treated as drawn
+   ## (e.g. when they have been drawn elsewhere)
+   def ClearDrawDirty(self):
+      self.draw_dirty = False
+      self.setPositionsUsed()
+      if self.objects_draw_dirty:
+         for obj in self.objects_ordered:
+            obj.ClearDrawDirty()
+         self.objects_draw_dirty = False
 ########################################
    def InitParent(self):
       self.parent = None
@@ -971,15 +1547,21 @@ class CFigObject(object):
       if self.parent != None:
          self.idx = self.parent.ObjectsCount
          self.parent.objects_cnt += 1
+      self.actObjectAfterRootChange()
+
+   ## Subobjects keep their parents (and indices),
+   ## only their depth and root object change
+   def actObjectAfterRootChange(self):
+      if self.parent != None:
          self.depth = self.parent.depth+1
          self.root_object = self.parent.RootObject
 
       if self.draw != None:
          self.draw.cleanSharedDrawObjectAttrs(force=True)
-         self.draw.SetAttrs()
+         self.draw.SetDrawAttrs()
 
       for obj in self.objects_ordered:
-         obj.actObjectAfterParentChange()
+         obj.actObjectAfterRootChange()
 
    def rmObjectFromParent(self):
       if self.parent == None:
@@ -987,15 +1569,21 @@ class CFigObject(object):
       self.parent.objects_cnt -= 1
       ## And remove from objects if it was already inserted ..
       if self.parent.HasObject(self):
+         figure = self.TreeFigure
+         if figure != None:
+            figure.unregisterObjects(self)
          del self.parent.objects[self.key]
          del self.parent.objects_ordered[self.idx]
          for obj in self.parent.objects_ordered[self.idx:]:
             obj.idx -= 1
-            if obj.ObjectKeyBase == self.ObjectKeyBase:
-               obj.setObjectIdxSuffix(-1)
-         similar_objects = self.parent.SimilarObjects(self.ObjectKeyBase)
+         ## .. and decrement suffixes of following similar objects
+         similar_objects = self.parent.rmObjectFromKeyBaseIndex(self)
+         for obj in similar_objects:
+            obj.setObjectIdxSuffix(-1)
+         similar_objects = self.parent.objects_by_key_base.get(self.ObjectKeyBase, [])
          if len(similar_objects) == 1:
             similar_objects[0].setObjectIdxSuffix(-1)
+      self.parent.InvalidateGeometry()
 
    ## Can be set even before insertion !
    ## -> when so, 'objects_cnt' does not match
@@ -1011,6 +1599,7 @@ class CFigObject(object):
       else:
          self.parent = parent
 
+      self.InvalidateGeometry()
       self.actObjectAfterParentChange()
 
    def UnsetParent(self):
@@ -1029,6 +1618,54 @@ class CFigObject(object):
    @property
    def ObjectsCount(self):
       return self.objects_cnt
+
+   ## Figure whose tree of inserted objects contains this object
+   ## (it must be reachable from figure's dummy object)
+   @property
+   def TreeFigure(self):
+      obj = self
+      while obj.parent != None and obj.parent.HasObject(obj):
+         obj = obj.parent
+      if obj.parent != None or obj.figure == None or obj.figure._dummy_object != obj:
+         return None
+      return obj.figure
+
+   ## Keys from root object to this object, separated by '/'
+   @property
+   def ObjectPath(self):
+      keys = []
+      obj = self
+      while obj.parent != None:
+         keys.append(obj.key)
+         obj = obj.parent
+      return "/".join(reversed(keys))
+
+   ## Indices of objects in their parents from 'ancestor' to this object,
+   ## or 'None' if 'ancestor' is not its ancestor.
+   ## Comparison of these tuples respects preorder of objects.
+   def idxPathFrom(self, ancestor):
+      idxs = []
+      obj = self
+      while obj != ancestor:
+         if obj.parent == None:
+            return None
+         idxs.append(obj.idx)
+         obj = obj.parent
+      return tuple(reversed(idxs))
+
+   ## 'path' consists of keys or key bases separated by '/'
+   def GetObjectByPath(self, path):
+      obj = self
+      for key in path.split("/"):
+         if not key:
+            continue
+         subobj = obj.objects.get(key)
+         if subobj == None:
+            subobj = obj.GetObjectByKeyBase(key)
+            if subobj == None:
+               return None
+         obj = subobj
+      return obj
    
    @property
    def ObjectKeySplit(self):
@@ -1036,15 +1673,11 @@ class CFigObject(object):
 
    @property
    def ObjectKeyBase(self):
-      key_split = self.ObjectKeySplit
-      if len(key_split) == 2 and not str_is_int(key_split[1]):
-         return self.key
-      return key_split[0]
+      return self.key_base
 
    @property
    def ObjectIdxSuffix(self):
-      key_split = self.ObjectKeySplit
-      return None if len(key_split) == 1 or not str_is_int(key_split[1]) else int(key_split[1])
+      return self.key_suffix
 
    def setObjectIdxSuffix(self, inc=0, update_parent=True):
       if self.parent == None:
@@ -1056,23 +1689,38 @@ class CFigObject(object):
          idx = 1
       num = idx+inc
       suffix = "" if num == 0 else "_"+str(num)
-      self.key = self.ObjectKeyBase+suffix
+      self.setKey(self.ObjectKeyBase+suffix)
       if update_parent:
          self.parent.objects[self.key] = self
 
+   ## Key suffixes are only renumbered within the same key base,
+   ## so the index needs to be updated only on insertion and removal
+   def addObjectToKeyBaseIndex(self, object_):
+      objs = self.objects_by_key_base.setdefault(object_.ObjectKeyBase, [])
+      suffix = object_.ObjectIdxSuffix or 0
+      pos = len(objs)
+      while pos > 0 and (objs[pos-1].ObjectIdxSuffix or 0) > suffix:
+         pos -= 1
+      objs.insert(pos, object_)
+
+   ## Returns similar objects that followed the removed one
+   def rmObjectFromKeyBaseIndex(self, object_):
+      key_base = object_.ObjectKeyBase
+      objs = self.objects_by_key_base[key_base]
+      pos = objs.index(object_)
+      del objs[pos]
+      if not objs:
+         del self.objects_by_key_base[key_base]
+      return objs[pos:]
+
    def SimilarObjects(self, key_base):
-      objs = []
-      for obj in self.objects.values():
-         if obj.ObjectKeyBase == key_base:
-            idx = obj.ObjectIdxSuffix
-            objs.insert(0 if idx == None else idx-1, obj)
-      return objs
+      return list(self.objects_by_key_base.get(key_base, []))
 
    def SimilarObjectsCount(self, key_base):
-      return len(self.SimilarObjects(key_base))
+      return len(self.objects_by_key_base.get(key_base, []))
 
    def GetObjectByKeyBase(self, key_base, idx=0):
-      objs = self.SimilarObjects(key_base)
+      objs = self.objects_by_key_base.get(key_base)
       return None if not objs else objs[idx]
 
    def GetObjectByIdx(self, idx):
@@ -1083,18 +1731,64 @@ class CFigObject(object):
          return
       
       object_.SetParent(self)
+      self.insertObjectKey(object_)
+      object_.InvalidateGeometry()
+
+      figure = self.TreeFigure
+      if figure != None:
+         figure.registerObjects(object_)
+
+   ## Inserts several objects at once (e.g. a row of a group):
+   ## the batch is validated first, then all objects are inserted
+   ## and geometry is invalidated and objects are registered in figure
+   ## only once for all of them
+   ## (setting parents of objects not inserted yet does not invalidate
+   ## the parent, see 'InvalidateGeometry')
+   ## Returns newly inserted objects
+   def InsertObjects(self, objects):
+      objects = [obj for obj in objects if not self.HasObject(obj)]
+      if len(set(map(id, objects))) != len(objects):
+         raise ValueError("Objects to insert into '%s' are not unique." % self.key)
+      obj = self
+      while obj != None:
+         if obj in objects:
+            raise ValueError("Object '%s' cannot be inserted into its own subobject." % obj.key)
+         obj = obj.parent
+
+      for object_ in objects:
+         object_.SetParent(self)
+         self.insertObjectKey(object_)
+      if not objects:
+         return objects
+
+      if self.IsGroup:
+         self.InvalidateGeometry()
+      else:
+         for object_ in objects:
+            object_.InvalidateGeometry()
+
+      figure = self.TreeFigure
+      if figure != None:
+         for object_ in objects:
+            figure.registerObjects(object_)
+      return objects
+
+   ## Inserts object (with already set parent) under its key,
+   ## possibly incremented
+   def insertObjectKey(self, object_):
       key_base = object_.key
       num = self.SimilarObjectsCount(key_base)
       if num > 0:
          object_.setObjectIdxSuffix(num, update_parent=False)
          ## Move the first non-incremented object to incremented key
-         if key_base in self.objects.keys():
+         if key_base in self.objects:
             first_object = self.objects[key_base]
             first_object.setObjectIdxSuffix()
             self.objects_ordered[first_object.idx] = first_object
 
       self.objects[object_.key] = object_
       self.objects_ordered.append(object_)
+      self.addObjectToKeyBaseIndex(object_)
 ########################################
    ## Set external composed object, which has implemented 'PreDrawObject', 'DrawObject' and 'PostDrawObject' methods
    ## -> child of 'CDrawObjectBase'
@@ -1107,11 +1801,15 @@ class CFigObject(object):
 
    def SetDraw(self, draw):
       self.draw = draw
+      self.SetDrawDirty()
 
    def SetDrawObjectAttrs(self, **args):
       self.draw.SetAttrs(args)
 
    def SetDrawFromObject(self, object_, **draw_args):
+      if self.draw == None and not draw_args:
+         self.SetDraw(object_.draw.CloneForObject(self))
+         return
       if self.draw == None:
          self.SetDrawByClass(object_.draw.__class__)
       else:
@@ -1133,17 +1831,24 @@ class CFigObject(object):
 
 
    ## Whole object and all its subobjects must be properly set at this moment!
-   def Draw(self):
+   ## With 'dirty_only', only objects with dirty draw are drawn
+   ## (see 'redraw_dirty_only' in 'CDrawObjectBase')
+   def Draw(self, dirty_only=False):
       if self.IsRoot:
          self.draw.PreDrawRootObject()
       
-      self.draw.PreDrawObject()
-      self.draw.DrawObject()
-      self.draw.PostDrawObject()
+      if not dirty_only or self.draw_dirty:
+         self.draw.PreDrawObject()
+         self.draw.DrawObject()
+         self.draw.PostDrawObject()
+      self.draw_dirty = False
+      self.setPositionsUsed()
 
       ## We want to keep objects order (the latest object to be the uppermost)
       for obj in self.objects_ordered:
-         obj.Draw()
+         if not dirty_only or obj.IsDrawDirty:
+            obj.Draw(dirty_only)
+      self.objects_draw_dirty = False
 
       if self.IsRoot:
          self.draw.PostDrawRootObject()
@@ -1317,6 +2022,78 @@ if __name__ == "__main__":
    group.Draw()
    print
 
+   print "Add objects overflowing subgroup on the left and centered one"
+   print "(root group cannot move, so all its subobjects are shifted):"
+   subgroup.InsertObject(CFigObject(key='overflow', width_mm=2, height_mm=2, xoffs_mm=-3, yoffs_mm=-1))
+   subgroup.InsertObject(CFigObject(key='centered', width_mm=2, height_mm=2, xoffs_mm=4, yalign='center'))
+   group.SolveGeometry()
+   group.Draw()
+   print
+
+   print "Overflow of group does not move its other subobjects:"
+   root = CFigObject('root', width_mm=40, height_mm=40)
+   group = CFigObject('group', xoffs_mm=10, yoffs_mm=10)
+   root.InsertObject(group)
+   group.InsertObject(CFigObject(key='centered', width_mm=4, height_mm=4, xalign='center', yalign='center'))
+   group.InsertObject(CFigObject(key='left', width_mm=20, height_mm=20))
+   group.InsertObject(CFigObject(key='right', width_mm=6, height_mm=6, xalign='right', yalign='bottom'))
+   positions = [obj.AbsBegin_mm for obj in group.objects_ordered]
+   group.InsertObject(CFigObject(key='overflow', width_mm=3, height_mm=3, xoffs_mm=-6, yoffs_mm=-6))
+   root.Draw()
+   print "Positions kept:", positions == [obj.AbsBegin_mm for obj in group.objects_ordered[:len(positions)]]
+   print
+
+   print "Overflow on the right (bottom) side does not move other subobjects either:"
+   positions = [obj.AbsBegin_mm for obj in group.objects_ordered]
+   group.InsertObject(CFigObject(key='end_overflow', width_mm=3, height_mm=3, xalign='right', yalign='bottom', xoffs_mm=5, yoffs_mm=5))
+   root.Draw()
+   print "Positions kept:", positions == [obj.AbsBegin_mm for obj in group.objects_ordered[:len(positions)]]
+   print
+
+   print "Copy of overflowing group and object right of it:"
+   group_copy = cp.deepcopy(group)
+   group_copy.SetPosFromObject(group)
+   root.InsertObject(group_copy)
+   right = CFigObject(key='right', width_mm=2, height_mm=2)
+   right.SetPosFromObject(group, xloc='rightof')
+   root.InsertObject(right)
+   root.Draw()
+   print "Copy at the same positions:", [(obj.AbsBegin_mm, obj.Size_mm) for obj in [group]+group.objects_ordered] == [(obj.AbsBegin_mm, obj.Size_mm) for obj in [group_copy]+group_copy.objects_ordered]
+   print "Right of group:", right.AbsBegin_mm[0] == group.AbsEnd_mm[0]
+   print
+
+   print "Cached positions after repeated inserts and changes are the same as evaluated again:"
+   group_root = CFigObject(key='root', width_mm=50, height_mm=50)
+   rows = CFigObject(key='rows', xalign='center')
+   group_root.InsertObject(rows)
+   for idx in range(6):
+      row = CFigObject(key='row', yoffs_mm=3*idx, xoffs_mm=-idx, xalign=['left','right','center'][idx%3])
+      rows.InsertObject(row)
+      for idx2 in range(3):
+         row.InsertObject(CFigObject(key='obj', width_mm=2, height_mm=2, xoffs_mm=2*idx2))
+      row.objects_ordered[0].AbsBegin_mm
+      rows.objects_ordered[0].SetSize(height_mm=idx)
+   objects = [group_root]
+   for obj in objects:
+      objects.extend(obj.objects_ordered)
+   cached = [(obj.AbsBegin_mm, obj.Size_mm) for obj in objects]
+   for obj in objects:
+      obj.ClearGeometryCache()
+   print "Same:", cached == [(obj.AbsBegin_mm, obj.Size_mm) for obj in objects]
+   print
+
+   print "Merge of frozen and mutable dictionaries:"
+   frozen = freeze_dict({'text': {'size': 1, 'color': 'black'}})
+   mutable = {'text': {'size': 2}, 'shadow': {'offs': 1}}
+   merged = merge_dicts(frozen, mutable)
+   merged['text']['color'] = 'white'
+   merged['shadow']['offs'] = 2
+   print "Merged mutable:", sorted(merged['text'].items()), sorted(merged['shadow'].items())
+   print "Inputs kept:", sorted(frozen['text'].items()), sorted(mutable['text'].items()), sorted(mutable['shadow'].items())
+   frozen2 = freeze_dict({'text': {'size': 3}})
+   print "Merge of frozen memoized:", merge_2dicts_rec(frozen, frozen2) is merge_2dicts_rec(frozen, frozen2)
+   print
+
    print "\n<</CFigObject tests>>"
 
 
@@ -8,8 +8,21 @@ from __future__ import division
 from collections import defaultdict
 from collections import OrderedDict
 
+from contextlib import contextmanager
+
 import copy as cp
+import cPickle as pickle
+import functools
+import hashlib
+import heapq
+import importlib
+import inspect
+import json
+import os
+import Queue
 import sys
+import threading
+import time
 
 import fig_object as fo
 
@@ -57,6 +70,11 @@ class CDrawFigureBase(fo.CCompositionBase):
    ## Override this - things that need to be set up after all drawing done
    def PostDrawFigure(self):
       pass
+########################################
+   ## Override this - paths of files that drawing of the figure produces
+   ## (see 'CBuildManifest' in 'fig_collection')
+   def OutputPaths(self):
+      return []
 ################################################################################
 
 ################################################################################
@@ -82,6 +100,27 @@ class CDrawFigurePrint(CDrawFigureBase):
 ################################################################################
 ################################################################################
 
+## Decorator of methods of layouts that modify tree of figure objects:
+## they hold the lock of layout figure
+## (see 'layoutBranch' in 'CLayoutFigureBase')
+def tree_mutator(f):
+   @functools.wraps(f)
+   def wrapper(self, *args, **kwargs):
+      with self.ptr.layouts_lock:
+         return f(self, *args, **kwargs)
+   return wrapper
+
+## Merges declarations of accesses of branches by ranks
+## (see 'ranks_access' in 'CLayout'),
+## paths of the same rank are joined
+def merge_ranks_access(*ranks_accesses):
+   merged = {}
+   for ranks_access in ranks_accesses:
+      for rank, (reads, writes) in ranks_access.items():
+         merged_reads, merged_writes = merged.get(rank, ([], []))
+         merged[rank] = (fo.merge_lists(merged_reads, reads), fo.merge_lists(merged_writes, writes))
+   return merged
+
 ################################################################################
 class CLayout(fo.CCompositionBase):
    """
@@ -141,6 +180,12 @@ class CLayout(fo.CCompositionBase):
       'draw_object_args' : {},
    })
 
+   ## Attributes are read only through '__getattr__'
+   ## so that branches can be tracked (see 'LayoutTracked')
+   attrs_as_members = False
+   ## Record of currently tracked branch
+   layout_track = None
+
    ## Branch ranks used only within this class' 'Layout'
    local_ranks = [0]
    ## Disable inheritance if 'ranks_' as it will be merged in 'ranks()'
@@ -157,9 +202,78 @@ class CLayout(fo.CCompositionBase):
    def Ranks(self):
       return self.__class__.ranks()
 ########################################
-   @property
-   def LayoutKey(self):
-      id_ = self.__class__.__name__[len('CLayout'):]
+   ## Paths of objects (see 'GetObjectByPath' in 'CFigure')
+   ## that branches of the layout read and whose subtrees they write
+   ## (insertion of an object writes its parent, '' is the figure itself).
+   ## 'None' means unknown - such branches depend on all other branches
+   ## and they hold the lock of layout figure all the time,
+   ## while branches with declared access hold it
+   ## only when they modify the tree (see 'tree_mutator').
+   ## 'ranks_access' declares pairs of these paths by ranks
+   ## (see 'merge_ranks_access'), the others are used for remaining ranks.
+   layout_reads = None
+   layout_writes = None
+   ranks_access = {}
+
+   def LayoutAccess(self, rank):
+      try:
+         return self.ranks_access[rank]
+      except KeyError:
+         return (self.layout_reads, self.layout_writes)
+
+   def IsAccessDeclared(self, rank):
+      reads, writes = self.LayoutAccess(rank)
+      return reads != None and writes != None
+
+   @staticmethod
+   def pathsOverlap(paths1, paths2):
+      for path1 in paths1:
+         for path2 in paths2:
+            if (path1 == path2 or not path1 or not path2
+               or path1.startswith(path2+"/") or path2.startswith(path1+"/")
+            ):
+               return True
+      return False
+
+   ## Whether branches of this and other layout
+   ## with given ranks must not run concurrently
+   def ConflictsWith(self, rank, layout, layout_rank):
+      reads, writes = self.LayoutAccess(rank)
+      layout_reads, layout_writes = layout.LayoutAccess(layout_rank)
+      if writes == None or layout_writes == None or reads == None or layout_reads == None:
+         return True
+      return (self.pathsOverlap(writes, layout_reads+layout_writes)
+         or self.pathsOverlap(layout_writes, reads)
+      )
+
+   ## Branches with declared access that modify figure objects directly
+   ## (not through methods of layouts) should hold this lock meanwhile
+   def Locked(self):
+      return self.ptr.layouts_lock
+
+   ## Releases the lock of layout figure however many times it is held
+   ## by current thread, use this for heavy work that does not access figure objects
+   ## (e.g. loading of assets) to run it concurrently with other branches
+   @contextmanager
+   def Unlocked(self):
+      lock = self.ptr.layouts_lock
+      depth = 0
+      try:
+         while True:
+            lock.release()
+            depth += 1
+      except RuntimeError:
+         ## Not held anymore
+         pass
+      try:
+         yield
+      finally:
+         for idx in range(depth):
+            lock.acquire()
+########################################
+   @classmethod
+   def layoutKey(cls):
+      id_ = cls.__name__[len('CLayout'):]
       key = ''
       for c in id_:
          if c.islower():
@@ -167,44 +281,78 @@ class CLayout(fo.CCompositionBase):
          else:
             key += "_"+c.lower()
       return key[1:] if key[-1] != "_" else key[1:-1]
+
+   @property
+   def LayoutKey(self):
+      return layout_registry.ClassKey(self.__class__)
 ########################################
    ## Insert figure object to layout,
    ## i.e. insert it into its parent
    ## that may not have been inserted yet,
    ## or into explicit parent
+   @tree_mutator
    def InsertObject(self, object_, parent=None):
       if parent == None:
          parent = object_.parent
       if parent != None:
          parent.InsertObject(object_)
+      if self.layout_track != None:
+         self.layout_track.InsertObject(object_)
+
+   ## Insert figure objects into the same parent at once
+   ## (see 'InsertObjects' in 'CFigObject')
+   @tree_mutator
+   def InsertObjects(self, objects, parent):
+      objects = parent.InsertObjects(objects)
+      if self.layout_track != None:
+         for object_ in objects:
+            self.layout_track.InsertObject(object_)
+      return objects
 ########################################
    ## Returns newly created figure object,
    ## which is automatically added into layout
    ## and will be inserted in next 'DoLayout' call
    ## 'SetDrawObjectClass' should have beeen called before
+   ## Object is created and inserted under one lock, as its index
+   ## is set already by creation (see 'SetParent' in 'CFigObject')
+   @tree_mutator
    def AddObjectToLayout(self, key, width_mm=fo.DEFAULT, height_mm=fo.DEFAULT,
       parent=fo.DEFAULT,
       xalign=fo.DEFAULT, yalign=fo.DEFAULT, xoffs_mm=fo.DEFAULT, yoffs_mm=fo.DEFAULT,
       margin_mm=fo.DEFAULT, opacity=fo.DEFAULT,
       **draw_object_args
    ):
-      self.SetFunctionAttrDefaults(key,2)
-      parent = self.args.parent
+      obj = self.CreateObject(key, width_mm=width_mm, height_mm=height_mm,
+         parent=parent,
+         xalign=xalign, yalign=yalign, xoffs_mm=xoffs_mm, yoffs_mm=yoffs_mm,
+         margin_mm=margin_mm, opacity=opacity,
+         **draw_object_args
+      )
+      self.InsertObject(obj)
+      return obj
+
+   ## Returns newly created figure object with set parent,
+   ## but not inserted yet
+   @tree_mutator
+   @fo.attr_defaults_args('key', 2)
+   def CreateObject(self, key, width_mm=fo.DEFAULT, height_mm=fo.DEFAULT,
+      parent=fo.DEFAULT,
+      xalign=fo.DEFAULT, yalign=fo.DEFAULT, xoffs_mm=fo.DEFAULT, yoffs_mm=fo.DEFAULT,
+      margin_mm=fo.DEFAULT, opacity=fo.DEFAULT,
+      **draw_object_args
+   ):
       root_object = self._dummy_object if parent == None else parent.RootObject
       if parent == None:
          parent = root_object
 
-      obj = fo.CFigObject(key, figure=self.ptr, resolution_ppi=self.Resolution_ppi, width_mm=self.args.width_mm, height_mm=self.args.height_mm,
-         xalign=self.args.xalign, yalign=self.args.yalign, xoffs_mm=self.args.xoffs_mm, yoffs_mm=self.args.yoffs_mm,
+      obj = fo.CFigObject(key, figure=self.ptr, resolution_ppi=self.Resolution_ppi, width_mm=width_mm, height_mm=height_mm,
+         xalign=xalign, yalign=yalign, xoffs_mm=xoffs_mm, yoffs_mm=yoffs_mm,
          parent=parent,
-         margin_mm=self.args.margin_mm,
-         opacity=self.args.opacity,
+         margin_mm=margin_mm,
+         opacity=opacity,
          draw_class=self.draw.draw_object_class,
-         **self.args.draw_object_args
+         **draw_object_args
       )
-
-      self.InsertObject(obj)
-      self.CleanFunctionAttrDefaults()
       return obj
 
    def AddRootObjectToLayout(self, key,
@@ -218,6 +366,9 @@ class CLayout(fo.CCompositionBase):
          **draw_object_args
       )
 
+   ## Defaults are prefixed with key of the copy
+   @tree_mutator
+   @fo.attr_defaults_args(lambda args: args['object_'].ObjectKeyBase if args['new_key'] == None else args['new_key'], 2)
    def AddObjectCopyToLayout(self, object_, deepcopy=True, new_key=None, new_parent=None,
       xloc=fo.DEFAULT, yloc=fo.DEFAULT, add_xoffs_mm=fo.DEFAULT, add_yoffs_mm=fo.DEFAULT,
       new_opacity=fo.DEFAULT,
@@ -230,15 +381,13 @@ class CLayout(fo.CCompositionBase):
       if new_parent != None:
          obj.SetParent(new_parent)
 
-      self.SetFunctionAttrDefaults(obj.key,2)
-      obj.SetOpacity(self.args.new_opacity)
+      obj.SetOpacity(new_opacity)
       
-      obj.SetSize(scale=self.args.scale, width_mm=self.args.new_width_mm, height_mm=self.args.new_height_mm, margin_mm=self.args.new_margin_mm)
-      obj.SetPosFromObject(object_, xloc=self.args.xloc, yloc=self.args.yloc, add_xoffs_mm=self.args.add_xoffs_mm, add_yoffs_mm=self.args.add_yoffs_mm)
-      obj.SetDrawObjectAttrs(**self.args.draw_object_args)
+      obj.SetSize(scale=scale, width_mm=new_width_mm, height_mm=new_height_mm, margin_mm=new_margin_mm)
+      obj.SetPosFromObject(object_, xloc=xloc, yloc=yloc, add_xoffs_mm=add_xoffs_mm, add_yoffs_mm=add_yoffs_mm)
+      obj.SetDrawObjectAttrs(**draw_object_args)
 
       self.InsertObject(obj)
-      self.CleanFunctionAttrDefaults()
       return obj
 
    def AddObjectGroupToLayout(self, key_prefix, parent,
@@ -258,23 +407,36 @@ class CLayout(fo.CCompositionBase):
       )
       return obj
 
-   ## One often wants to use 'None' in 'xloc' and 'yloc'
-   ## (do not discard previous position by default)
+   @tree_mutator
    def addObjectToGroup(self, parent, object_,
       xloc=fo.DEFAULT, add_xoffs_mm=fo.DEFAULT,
       yloc=fo.DEFAULT, add_yoffs_mm=fo.DEFAULT,
    ):
-      self.SetFunctionAttrDefaults(object_.key,3)
       object_.SetParent(parent)
-      if parent.ObjectsCount > 1:
-         object_.SetPosFromObject(parent.objects_ordered[-1],
-            xloc=self.args.xloc, add_xoffs_mm=self.args.add_xoffs_mm,
-            yloc=self.args.yloc, add_yoffs_mm=self.args.add_yoffs_mm,
-         )
+      self.setObjectPosInGroup(None if parent.ObjectsCount <= 1 else parent.objects_ordered[-1], object_,
+         xloc=xloc, add_xoffs_mm=add_xoffs_mm,
+         yloc=yloc, add_yoffs_mm=add_yoffs_mm,
+      )
       self.InsertObject(object_)
-      self.CleanFunctionAttrDefaults()
       return object_
 
+   ## Positions object next to the previous object of the group, if any
+   ## One often wants to use 'None' in 'xloc' and 'yloc'
+   ## (do not discard previous position by default)
+   @fo.attr_defaults_args(lambda args: args['object_'].key, 3)
+   def setObjectPosInGroup(self, prev_object, object_,
+      xloc=fo.DEFAULT, add_xoffs_mm=fo.DEFAULT,
+      yloc=fo.DEFAULT, add_yoffs_mm=fo.DEFAULT,
+   ):
+      if prev_object != None:
+         object_.SetPosFromObject(prev_object,
+            xloc=xloc, add_xoffs_mm=add_xoffs_mm,
+            yloc=yloc, add_yoffs_mm=add_yoffs_mm,
+         )
+
+   ## Object is created right within the group
+   ## and inserted under one lock (see 'AddObjectToLayout')
+   @tree_mutator
    def AddObjectToGroup(self, key, parent,
       width_mm=fo.DEFAULT, height_mm=fo.DEFAULT,
       xalign=fo.DEFAULT, xoffs_mm=fo.DEFAULT,
@@ -285,8 +447,9 @@ class CLayout(fo.CCompositionBase):
       opacity=fo.DEFAULT,
       **draw_object_args
    ):
-      obj = self.AddObjectToLayout(key=key,
+      obj = self.CreateObject(key=key,
          width_mm=width_mm, height_mm=height_mm,
+         parent=parent,
          xalign=xalign, xoffs_mm=xoffs_mm,
          yalign=yalign, yoffs_mm=yoffs_mm,
          margin_mm=margin_mm,
@@ -298,6 +461,31 @@ class CLayout(fo.CCompositionBase):
          yloc=yloc, add_yoffs_mm=add_yoffs_mm,
       )
       return obj
+
+   ## Adds objects given by pairs of key and dictionary of arguments
+   ## of 'AddObjectToGroup' into group at once:
+   ## objects are created right within the group,
+   ## each is positioned next to the previous one
+   ## and all are inserted together (see 'InsertObjects' in 'CFigObject').
+   ## 'set_f(object, idx)' can set up each object before it is positioned
+   ## (e.g. its size).
+   @tree_mutator
+   def AddObjectsToGroup(self, parent, specs, set_f=None):
+      objs = []
+      prev_object = None if not parent.objects_ordered else parent.objects_ordered[-1]
+      for idx, (key, args) in enumerate(specs):
+         args = dict(args)
+         pos_args = {}
+         for arg_key in ('xloc', 'add_xoffs_mm', 'yloc', 'add_yoffs_mm'):
+            if arg_key in args:
+               pos_args[arg_key] = args.pop(arg_key)
+         obj = self.CreateObject(key, parent=parent, **args)
+         if set_f != None:
+            set_f(obj, idx)
+         self.setObjectPosInGroup(None if parent.ObjectsCount <= 1 else prev_object, obj, **pos_args)
+         objs.append(obj)
+         prev_object = obj
+      return self.InsertObjects(objs, parent)
 ########################################
    def ReturnRank(self, act_rank):
       for rank in self.Ranks():
@@ -317,9 +505,59 @@ class CLayout(fo.CCompositionBase):
       if rank == 0:
          pass
       return self.ReturnRank(rank)
-########################################
 
+   ## Same as 'Layout', but records what the branch reads and inserts
+   ## (see 'CLayoutTrack'): attributes of the layout are read only through
+   ## '__getattr__' (see 'attrs_as_members' in 'CCompositionBase'),
+   ## objects are inserted through 'InsertObject' or 'InsertObjects'
+   def LayoutTracked(self, rank=0):
+      track = CLayoutTrack()
+      self.layout_track = track
+      self.attrs_read = track.attr_keys
+      try:
+         self.Layout(rank)
+      finally:
+         del self.attrs_read
+         del self.layout_track
+      track.SetRootsRead(self.ptr.ptr)
+      return track
+################################################################################
+
+################################################################################
+class CLayoutTrack(object):
+   """
+   Record of single layout branch:
+   keys of attributes it reads (both of the layout and of the figure),
+   keys of root objects it reads and writes
+   and objects it inserts in order of insertion.
+   Branches are supposed to modify only objects they insert
+   and to reach other objects through figure's attributes (e.g. 'self.front').
+   """
+########################################
+   def __init__(self):
+      self.attr_keys = set()
+      self.roots_read = set()
+      self.roots_written = set()
+      self.objects = []
 ########################################
+   def InsertObject(self, object_):
+      if object_ not in self.objects:
+         self.objects.append(object_)
+      self.roots_written.add(object_.RootObject.key)
+
+   def SetRootsRead(self, figure):
+      for attr_key in self.attr_keys:
+         obj = figure.__dict__.get(attr_key)
+         if isinstance(obj, fo.CFigObject) and obj.depth >= 0:
+            self.roots_read.add(obj.RootObject.key)
+
+   ## Root objects whose trees the branch depends on
+   @property
+   def Roots(self):
+      return self.roots_read | self.roots_written
+################################################################################
+
+################################################################################
 class CLayoutFront(CLayout):
    """
    Layout that adds front root object
@@ -330,6 +568,9 @@ class CLayoutFront(CLayout):
 
    local_ranks = [0]
    ranks_ = None
+
+   layout_reads = []
+   layout_writes = ['']
 ########################################
    ## Creates very common root figure object
    def Layout(self, rank=0):
@@ -347,6 +588,9 @@ class CLayoutBack(CLayout):
 
    local_ranks = [0]
    ranks_ = None
+
+   layout_reads = []
+   layout_writes = ['']
 ########################################
    ## Creates very common root figure object
    def Layout(self, rank=0):
@@ -355,6 +599,64 @@ class CLayoutBack(CLayout):
       return self.ReturnRank(rank)
 ################################################################################
 
+################################################################################
+class CLayoutRegistry(object):
+   """
+   Registry of layout classes by their keys
+   and of keys by layout classes (see 'layoutKey' in 'CLayout').
+   Classes are registered explicitly or lazily from modules
+   on their first lookup, so each one is resolved only once.
+   """
+########################################
+   def __init__(self):
+      ## (module name, layout key) -> layout class
+      self.classes = {}
+      ## Layout class -> layout key
+      self.keys = {}
+      ## Attribute key (e.g. 'layout_front') -> layout key or 'None'
+      self.attr_keys = {}
+########################################
+   def Register(self, class_, module_name=None, key=None):
+      if module_name == None:
+         module_name = class_.__module__
+      if key == None:
+         key = self.ClassKey(class_)
+      self.classes[(module_name, key)] = class_
+
+   def ClassKey(self, class_):
+      try:
+         return self.keys[class_]
+      except KeyError:
+         key = self.keys[class_] = class_.layoutKey()
+         return key
+
+   ## Layout class of given key in module, 'None' means this module
+   def LayoutClass(self, key, module_name=None):
+      if module_name == None:
+         module_name = __name__
+      try:
+         return self.classes[(module_name, key)]
+      except KeyError:
+         module = sys.modules.get(module_name)
+         if module == None:
+            module = importlib.import_module(module_name)
+         class_ = getattr(module, "CLayout"+fo.str_title(key))
+         self.Register(class_, module_name, key)
+         return class_
+
+   ## Layout key of attribute of layout figure,
+   ## 'None' if it is not an attribute of a layout
+   def AttrLayoutKey(self, attr_key):
+      try:
+         return self.attr_keys[attr_key]
+      except KeyError:
+         split_ = attr_key.split("_",1)
+         key = self.attr_keys[attr_key] = split_[1] if split_[0] == 'layout' and len(split_) > 1 else None
+         return key
+################################################################################
+
+layout_registry = CLayoutRegistry()
+
 ################################################################################
 class CLayoutFigureBase(fo.CCompositionBase):
    """
@@ -369,26 +671,44 @@ class CLayoutFigureBase(fo.CCompositionBase):
    ## concrete attributes are set in 'SetAttrs',
    ## default values should be defined in class variable 'attr_defaults'
    def __init__(self, figure, **args):
+      self.layouts_lock = threading.RLock()
       self.ClearLayouts()
       fo.CCompositionBase.__init__(self, figure, **args)
 ########################################
    def __copy__(self):
       layout = self.__class__(self.ptr, **self.attrs)
 ########################################
+   ## Attributes searched in the last layout by current thread:
+   ## the layout searches this object again (as its composed object),
+   ## so the search is not repeated (until the recursion limit)
+   last_layout_lookups = threading.local()
+
    def __getattr__(self, attr_key):
       try:
          return fo.CCompositionBase.__getattr__(self, attr_key)
       except AttributeError:
-         if hasattr(self.LastLayout, attr_key):
-            return getattr(self.LastLayout, attr_key)
-         raise
+         lookups = self.last_layout_lookups.__dict__.setdefault('keys', set())
+         lookup = (id(self), attr_key)
+         if lookup not in lookups:
+            lookups.add(lookup)
+            try:
+               if hasattr(self.LastLayout, attr_key):
+                  return getattr(self.LastLayout, attr_key)
+            finally:
+               lookups.discard(lookup)
+         raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, attr_key))
 ########################################
    def ClearLayouts(self):
       self.layouts = {}
       self.layouts_ordered = []
       self.layouts_pos = -1
       self.layouts_rank = 0
-      self.layouts_next_rank = None
+      self.layouts_tracks = None
+      self.clearRanks()
+
+   def clearRanks(self):
+      self.layouts_by_rank = None
+      self.layouts_ranks = None
 ########################################
    def CreateLayout(self, layout_class, **layout_args):
       return layout_class(self, **layout_args)
@@ -399,6 +719,7 @@ class CLayoutFigureBase(fo.CCompositionBase):
    def AddLayout(self, layout):
       self.layouts[layout.LayoutKey] = layout
       self.layouts_ordered.append(layout)
+      self.clearRanks()
 ########################################
    def AttrsFromLayouts(self):
       attrs = {}
@@ -409,19 +730,27 @@ class CLayoutFigureBase(fo.CCompositionBase):
    def AttrsWithLayouts(self):
       return fo.merge_dicts(self.AttrsFromLayouts(), self.attrs)
 
+   ## The same as 'DictsFromAttrs('layout', ...)' sorted by ranks,
+   ## with layout classes resolved by 'layout_registry'
    def AddLayoutsFromAttrs(self):
-      self.attrs = self.AttrsWithLayouts()
+      attrs = self.attrs = self.AttrsWithLayouts()
       self.ClearLayouts()
-      layouts = self.DictsFromAttrs('layout', sort_f=lambda l: 0 if not 'rank' in l[1] else l[1]['rank'])
-      for l in layouts:
-         key = l[0]
-         attrs = l[1]
-         if 'module' in attrs:
-            module = __import__(attrs['module'])
-         else:
-            module = sys.modules[__name__]
-         class_ = getattr(module, "CLayout"+fo.str_title(key))
-         self.AddLayoutByClass(class_, **attrs)
+      attrs_copy = dict(self.AttrDefaults())
+      attrs_copy.update(attrs)
+      layouts = []
+      for attr_key in attrs_copy:
+         key = layout_registry.AttrLayoutKey(attr_key)
+         if key == None:
+            continue
+         layout_attrs = attrs_copy[attr_key]
+         if fo.is_dict(layout_attrs):
+            class_ = layout_registry.LayoutClass(key, layout_attrs.get('module'))
+            layouts.append((layout_attrs.get('rank', 0), len(layouts), class_, layout_attrs))
+         if attr_key in attrs:
+            del attrs[attr_key]
+      layouts.sort()
+      for rank, idx, class_, layout_attrs in layouts:
+         self.AddLayoutByClass(class_, **layout_attrs)
 ########################################
    ## Do not override this
    def SetAttrs(self, attrs=None):
@@ -447,71 +776,653 @@ class CLayoutFigureBase(fo.CCompositionBase):
    def LastLayout(self):
       return self.layouts_ordered[self.LayoutsPos]
 
+   ## Dispatch table of positions of (flagged) layouts
+   ## by ranks they declare (see 'ranks' in 'CLayout')
+   ## and priority queue of following ranks
+   def initRanks(self):
+      self.layouts_by_rank = defaultdict(set)
+      for pos, layout in enumerate(self.layouts_ordered):
+         if layout.flag:
+            for rank in layout.Ranks():
+               self.layouts_by_rank[rank].add(pos)
+      self.layouts_ranks = [rank for rank in self.layouts_by_rank if rank > self.layouts_rank]
+      heapq.heapify(self.layouts_ranks)
+
    ## Executes range of layouts,
    ## if there are any left,
    ## which inserts figure objects.
    ## It is designed to be called multiple times
    ## and to step either by layout or whole rank.
+   ## Each layout is called only with ranks it declares.
    ## Do not override this.
    ## By default, process all layouts and ranks
    ## (when step is 'None').
    ## Returns whether any layout was processed.
    def LayoutFigure(self, rank_step=None, layout_step=None):
-      start = self.LayoutsPos+1
-      end = self.LayoutsCount if layout_step == None else min(start+layout_step, self.LayoutsCount)
-      layouts = self.layouts_ordered[start:end]
-
-      if not layouts or (rank_step != None and rank_step <= 0):
+      if rank_step != None and rank_step <= 0:
          return False
-      
-      flag = False
-      for layout in layouts:
-         if layout.flag:
-            flag = True
-            next_rank = layout.Layout(self.layouts_rank)
-            if (next_rank != None
-               and next_rank > self.layouts_rank
-               and (self.layouts_next_rank == None or next_rank < self.layouts_next_rank)
-            ):
-               self.layouts_next_rank = next_rank
-      self.layouts_pos = end-1
+      if self.layouts_by_rank == None:
+         self.initRanks()
 
-      if (self.LayoutsPos == self.LayoutsCount-1
-         and self.layouts_next_rank != None and self.layouts_next_rank > self.layouts_rank
-      ):
+      flag = False
+      while True:
+         start = self.LayoutsPos+1
+         end = self.LayoutsCount if layout_step == None else min(start+layout_step, self.LayoutsCount)
+         if start >= end:
+            return flag
+
+         rank_layouts = self.layouts_by_rank.get(self.layouts_rank, ())
+         for pos in range(start, end):
+            layout = self.layouts_ordered[pos]
+            if layout.flag:
+               flag = True
+               if pos in rank_layouts:
+                  self.layoutBranch((self.layouts_rank, pos))
+         self.layouts_pos = end-1
+
+         if self.LayoutsPos < self.LayoutsCount-1 or not self.layouts_ranks:
+            return flag
          ## All layouts processed, but not all ranks -> next cycle
-         self.layouts_rank = self.layouts_next_rank
-         self.layouts_next_rank = None
+         self.layouts_rank = heapq.heappop(self.layouts_ranks)
          self.layouts_pos = -1
          if rank_step != None:
             rank_step -= 1
             if rank_step <= 0:
                ## Given step of ranks exceeded
                return flag
-         flag |= self.LayoutFigure(rank_step, layout_step)
-      return flag
+########################################
+   ## Branches with undeclared access hold the lock all the time
+   ## (see 'LayoutAccess' in 'CLayout')
+   def layoutBranch(self, branch):
+      rank, pos = branch
+      if self.layouts_ordered[pos].IsAccessDeclared(rank):
+         self.profileBranch(branch)
+      else:
+         with self.layouts_lock:
+            self.profileBranch(branch)
+
+   def profileBranch(self, branch):
+      profiler = self.ptr.layout_profiler
+      if profiler == None:
+         self.runBranch(branch)
+      else:
+         rank, pos = branch
+         with profiler.Profile(self.layouts_ordered[pos].LayoutKey, rank, self.ptr.idx):
+            self.runBranch(branch)
+
+   def runBranch(self, branch):
+      rank, pos = branch
+      layout = self.layouts_ordered[pos]
+      if self.layouts_tracks == None:
+         layout.Layout(rank)
+      else:
+         self.layouts_tracks[branch] = layout.LayoutTracked(rank)
+
+   ## Tracks all following branches (see 'CLayoutTrack'),
+   ## only for layout of figure from scratch
+   def TrackLayouts(self):
+      if self.layouts_tracks == None and self.LayoutsPos == -1 and self.layouts_rank == 0:
+         self.layouts_tracks = {}
+      return self.layouts_tracks != None
+
+   ## Branches affected by changed attributes of layouts
+   ## (layout position -> keys) in order of their execution:
+   ## these which read any changed attribute
+   ## and following ones that depend on trees of root objects
+   ## written by already affected branches
+   def affectedBranches(self, changed_attr_keys):
+      affected = []
+      roots = set()
+      for branch in sorted(self.layouts_tracks):
+         track = self.layouts_tracks[branch]
+         if (roots & track.Roots
+            or not track.attr_keys.isdisjoint(changed_attr_keys.get(branch[1], ()))
+         ):
+            affected.append(branch)
+            roots |= track.roots_written
+      return affected
+
+   ## Updates attributes of layouts ('layout_...' items as in 'Set')
+   ## and lays out again only affected branches (see 'affectedBranches'):
+   ## objects inserted by them are removed and inserted again,
+   ## the rest of the tree is kept intact.
+   ## Returns 'None' if it is not possible
+   ## (branches were not tracked, other attributes or layouts' flags or ranks change),
+   ## otherwise whether any branch was laid out.
+   def UpdateAttrs(self, attrs):
+      if self.layouts_tracks == None:
+         return None
+      layouts_attrs = []
+      for attr_key, layout_attrs in attrs.items():
+         key = layout_registry.AttrLayoutKey(attr_key)
+         if key not in self.layouts or not fo.is_dict(layout_attrs):
+            return None
+         layout = self.layouts[key]
+         changed = {}
+         for layout_attr_key, value in layout_attrs.items():
+            old_value = layout.GetAttr(layout_attr_key)
+            if fo.is_dict(old_value):
+               value = fo.merge_dicts(old_value, value)
+            if value != old_value:
+               if layout_attr_key in ('flag', 'rank', 'module'):
+                  return None
+               changed[layout_attr_key] = value
+         layouts_attrs.append((layout, changed))
+
+      changed_attr_keys = {}
+      for layout, changed in layouts_attrs:
+         if changed:
+            layout.SetAttrs(changed)
+            changed_attr_keys[self.layouts_ordered.index(layout)] = set(changed)
+      if not changed_attr_keys:
+         return False
+
+      affected = self.affectedBranches(changed_attr_keys)
+      with self.layouts_lock:
+         for branch in reversed(affected):
+            for obj in reversed(self.layouts_tracks.pop(branch).objects):
+               obj.UnsetParent()
+         for branch in affected:
+            self.layoutBranch(branch)
+      return bool(affected)
+
+   ## Branches (rank, layout position) of flagged layouts
+   ## and their successors: each branch depends on preceding branches
+   ## (in order of ranks) that conflict with it (see 'ConflictsWith' in 'CLayout')
+   ## or of the same layout if they are tracked (see 'TrackLayouts'),
+   ## so branches of one layout must not share its state
+   ## unless they declare conflicting access
+   def layoutsGraph(self):
+      branches = sorted((rank, pos)
+         for pos, layout in enumerate(self.layouts_ordered) if layout.flag
+         for rank in layout.Ranks() if rank >= 0
+      )
+      deps_cnts = dict((branch, 0) for branch in branches)
+      succs = defaultdict(list)
+      for idx, branch in enumerate(branches):
+         rank, pos = branch
+         layout = self.layouts_ordered[pos]
+         for prev_branch in branches[:idx]:
+            prev_rank, prev_pos = prev_branch
+            if ((prev_pos == pos and self.layouts_tracks != None)
+               or self.layouts_ordered[prev_pos].ConflictsWith(prev_rank, layout, rank)
+            ):
+               succs[prev_branch].append(branch)
+               deps_cnts[branch] += 1
+      return branches, deps_cnts, succs
+
+   ## Executes all layouts at once according to dependencies of their branches,
+   ## ranks only decide which of independent branches goes first.
+   ## Independent branches run concurrently in 'pool'
+   ## (e.g. 'multiprocessing.pool.ThreadPool'), if given.
+   ## Only for layout of figure from scratch,
+   ## otherwise it is the same as 'LayoutFigure'.
+   ## Returns whether any layout was processed.
+   def LayoutFigureGraph(self, pool=None):
+      if self.LayoutsPos != -1 or self.layouts_rank != 0:
+         return self.LayoutFigure()
+
+      branches, deps_cnts, succs = self.layoutsGraph()
+      ready = [branch for branch in branches if not deps_cnts[branch]]
+      heapq.heapify(ready)
+      done = Queue.Queue()
+      running = 0
+
+      def run(branch):
+         try:
+            self.layoutBranch(branch)
+            return (branch, None)
+         except Exception:
+            return (branch, sys.exc_info())
+
+      while ready or running:
+         if ready:
+            branch = heapq.heappop(ready)
+            if pool == None:
+               done.put(run(branch))
+            else:
+               pool.apply_async(run, (branch,), callback=done.put)
+            running += 1
+            if pool != None:
+               continue
+         branch, exc_info = done.get()
+         running -= 1
+         if exc_info != None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+         for succ in succs[branch]:
+            deps_cnts[succ] -= 1
+            if not deps_cnts[succ]:
+               heapq.heappush(ready, succ)
+
+      self.layouts_pos = self.LayoutsCount-1
+      self.layouts_rank = 0 if not branches else branches[-1][0]
+      self.clearRanks()
+      return bool(branches)
 ################################################################################
 
+################################################################################
 ################################################################################
 ################################################################################
 
+################################################################################
+class CLayoutPlans(object):
+   """
+   Class that records laid out trees of figures (layout plans)
+   by all inputs of their layouts
+   (figure sizes, draw and layout classes and attributes)
+   and replays them for following figures with the same inputs,
+   instead of running all their layouts again.
+   Only complete layouts of figures without any objects are recorded,
+   as layouts can branch on any attribute.
+   One instance is meant to be shared by figures of a collection.
+   """
+########################################
+   def __init__(self, max_plans=256):
+      self.plans = {}
+      self.max_plans = max_plans
+########################################
+   ## Returns 'None' if the inputs are not hashable
+   def PlanKey(self, figure):
+      layout = figure.layout
+      if figure.draw == None:
+         return None
+      try:
+         return fo.hashable_value((
+            figure._dummy_object.size_mm, figure.Resolution_ppi,
+            figure.draw.__class__, figure.draw.draw_object_class, figure.draw.attrs,
+            layout.__class__, layout.attrs,
+            [(l.__class__, l.attrs) for l in layout.layouts_ordered],
+         ))
+      except TypeError:
+         return None
+########################################
+   ## Module name -> hash of its source code
+   modules_hashes = {}
+########################################
+   @classmethod
+   def moduleHash(cls, module_name):
+      hash_ = cls.modules_hashes.get(module_name)
+      if hash_ == None:
+         module = sys.modules.get(module_name)
+         try:
+            with open(inspect.getsourcefile(module), 'rb') as f:
+               hash_ = hashlib.sha1(f.read()).hexdigest()
+         except (TypeError, IOError):
+            ## Built-in module
+            hash_ = ''
+         cls.modules_hashes[module_name] = hash_
+      return hash_
+
+   def FigureClasses(self, figure):
+      layout = figure.layout
+      return [figure.draw.__class__, figure.draw.draw_object_class, layout.__class__]+[l.__class__ for l in layout.layouts_ordered]
+
+   def CodeVersion(self, figure):
+      modules_names = set(class_.__module__ for figure_class in self.FigureClasses(figure) for class_ in inspect.getmro(figure_class))
+      return hashlib.sha1(" ".join(self.moduleHash(name) for name in sorted(modules_names))).hexdigest()
+
+   ## Representation of the key is stable between runs
+   ## (dictionaries are sorted in it)
+   def KeyDigest(self, key, figure):
+      return hashlib.sha1(repr(key)+self.CodeVersion(figure)).hexdigest()
+
+   ## Digest of all inputs and code of layouts of figure,
+   ## 'None' if the inputs are not hashable
+   def FigureDigest(self, figure):
+      key = self.PlanKey(figure)
+      return None if key == None else self.KeyDigest(key, figure)
+########################################
+   def IsFigureFresh(self, figure):
+      layout = figure.layout
+      return figure.RootObjectsCount == 0 and layout.LayoutsPos == -1 and layout.layouts_rank == 0
+########################################
+   def recordObject(self, object_):
+      return (
+         object_.__class__, object_.key,
+         object_.resolution_ppi, object_.size_mm, object_.margin_mm,
+         object_.offs_mm, object_.align, object_.opacity,
+         None if object_.draw == None else (object_.draw.__class__, object_.draw.DrawState()),
+         [self.recordObject(obj) for obj in object_.objects_ordered],
+      )
+
+   ## Figure attributes that refer to root objects (e.g. 'front')
+   ## are recorded too
+   def Record(self, figure, ret):
+      root_objects_idxs = dict((id(obj), obj.idx) for obj in figure.root_objects)
+      layout = figure.layout
+      return (
+         [self.recordObject(obj) for obj in figure.root_objects],
+         [(attr_key, root_objects_idxs[id(attr)]) for attr_key, attr in figure.__dict__.items() if id(attr) in root_objects_idxs],
+         (layout.layouts_pos, layout.layouts_rank),
+         ret,
+      )
+########################################
+   ## Keys are the final ones, so they are not incremented on insertion
+   def replayObject(self, record, parent, figure):
+      (class_, key, resolution_ppi, size_mm, margin_mm, offs_mm, align, opacity,
+         draw, records) = record
+      obj = class_(key, resolution_ppi=resolution_ppi,
+         width_mm=size_mm[0], height_mm=size_mm[1],
+         xalign=align[0], yalign=align[1], xoffs_mm=offs_mm[0], yoffs_mm=offs_mm[1],
+         parent=parent,
+         margin_mm=margin_mm, opacity=opacity,
+         figure=figure,
+         draw_class=None,
+      )
+      if draw != None:
+         obj.SetDraw(draw[0].fromDrawState(obj, draw[1]))
+      parent.InsertObject(obj)
+      for subrecord in records:
+         self.replayObject(subrecord, obj, figure)
+      return obj
+
+   def Replay(self, figure, plan):
+      records, figure_attrs, layout_state, ret = plan
+      ## As in 'AddObjectToLayout'
+      for record in records:
+         self.replayObject(record, figure._dummy_object, figure.layout)
+      for attr_key, idx in figure_attrs:
+         setattr(figure, attr_key, figure.GetRootObjectByIdx(idx))
+      layout = figure.layout
+      layout.layouts_pos, layout.layouts_rank = layout_state
+      layout.clearRanks()
+      return ret
+########################################
+   ## Complete layout of figure, replayed if possible
+   def LayoutFigure(self, figure):
+      layout = figure.layout
+      key = None if not self.IsFigureFresh(figure) else self.PlanKey(figure)
+      if key == None:
+         return figure.layoutFigure()
+      plan = self.GetPlan(key, figure)
+      if plan != None:
+         return self.Replay(figure, plan)
+      ret = figure.layoutFigure()
+      self.AddPlan(key, figure, self.Record(figure, ret))
+      return ret
+
+   ## Returns 'None' if there is no plan
+   def GetPlan(self, key, figure):
+      return self.plans.get(key)
+
+   def AddPlan(self, key, figure, plan):
+      if len(self.plans) >= self.max_plans:
+         self.plans.clear()
+      self.plans[key] = plan
+################################################################################
+
+################################################################################
+class CLayoutCache(CLayoutPlans):
+   """
+   Class of layout plans (see 'CLayoutPlans')
+   that are also stored on disk in directory 'path', one file per plan,
+   so that laid out trees of figures are reused by following runs.
+   Name of the file combines the plan key
+   and hash of source code of modules of all draw and layout classes
+   of the figure (including their superclasses),
+   thus any change of inputs or code of layouts makes a new plan.
+   Plans are pickled without handles of draw tools
+   (see 'DrawState' in 'CDrawObjectBase').
+   Outdated files are ignored, unreadable or corrupted ones are removed.
+   """
+########################################
+   extension = '.plan'
+########################################
+   def __init__(self, path, max_plans=256):
+      CLayoutPlans.__init__(self, max_plans)
+      self.path = path
+      if not os.path.isdir(path):
+         os.makedirs(path)
+########################################
+   def PlanPath(self, key, figure):
+      return os.path.join(self.path, self.KeyDigest(key, figure)+self.extension)
+########################################
+   ## Shape of plan read from disk is checked (see 'Record'),
+   ## as corrupted files can unpickle to anything
+   @classmethod
+   def isRecordValid(cls, record):
+      if not isinstance(record, tuple) or len(record) != 10:
+         return False
+      (class_, key, resolution_ppi, size_mm, margin_mm, offs_mm, align, opacity,
+         draw, records) = record
+      return (inspect.isclass(class_) and issubclass(class_, fo.CFigObject)
+         and fo.is_str(key)
+         and all(isinstance(value, (int, long, float)) for value in [resolution_ppi, margin_mm, opacity])
+         and all(isinstance(pair, (list, tuple)) and len(pair) == 2 for pair in [size_mm, offs_mm, align])
+         and all(isinstance(value, (int, long, float)) for value in list(size_mm)+list(offs_mm))
+         and all(align[idx] in class_.aligns[idx] for idx in range(2))
+         and (draw == None or cls.isDrawValid(draw))
+         and isinstance(records, list) and all(cls.isRecordValid(subrecord) for subrecord in records))
+
+   @classmethod
+   def isDrawValid(cls, draw):
+      if not isinstance(draw, tuple) or len(draw) != 2:
+         return False
+      draw_class, state = draw
+      return (inspect.isclass(draw_class) and issubclass(draw_class, fo.CDrawObjectBase)
+         and isinstance(state, tuple) and len(state) == 3
+         and fo.is_dict(state[0]) and fo.is_dict(state[1]) and isinstance(state[2], list)
+         and all(isinstance(effect, tuple) and len(effect) == 3
+            and fo.is_str(effect[0]) and fo.is_str(effect[1]) and fo.is_dict(effect[2])
+            and all(fo.is_str(attr_key) for attr_key in effect[2]) for effect in state[2]))
+
+   @classmethod
+   def IsPlanValid(cls, plan):
+      if not isinstance(plan, tuple) or len(plan) != 4:
+         return False
+      records, figure_attrs, layout_state, ret = plan
+      return (isinstance(records, list) and all(cls.isRecordValid(record) for record in records)
+         and isinstance(figure_attrs, list)
+         and all(isinstance(attr, tuple) and len(attr) == 2 and fo.is_str(attr[0])
+            and fo.is_int(attr[1]) and 0 <= attr[1] < len(records) for attr in figure_attrs)
+         and isinstance(layout_state, tuple) and len(layout_state) == 2
+         and all(fo.is_int(value) for value in layout_state))
+########################################
+   ## Files that cannot be loaded or do not contain a plan are removed
+   def GetPlan(self, key, figure):
+      plan = CLayoutPlans.GetPlan(self, key, figure)
+      if plan != None:
+         return plan
+      path = self.PlanPath(key, figure)
+      if not os.path.isfile(path):
+         return None
+      try:
+         with open(path, 'rb') as f:
+            plan = pickle.load(f)
+      except Exception:
+         plan = None
+      if not self.IsPlanValid(plan):
+         try:
+            os.remove(path)
+         except OSError:
+            pass
+         return None
+      CLayoutPlans.AddPlan(self, key, figure, plan)
+      return plan
+
+   ## File is written at once, so that it is never read incomplete
+   def AddPlan(self, key, figure, plan):
+      CLayoutPlans.AddPlan(self, key, figure, plan)
+      path = self.PlanPath(key, figure)
+      tmp_path = "%s.%d.tmp" % (path, os.getpid())
+      with open(tmp_path, 'wb') as f:
+         pickle.dump(plan, f, pickle.HIGHEST_PROTOCOL)
+      os.rename(tmp_path, path)
+################################################################################
+
+################################################################################
+class CLayoutProfiler(object):
+   """
+   Class that profiles layout branches (each layout with each its rank)
+   of figures: it records wall time, figure objects created,
+   deep copies of figure objects and 'merge_dicts' calls
+   per layout key, rank and figure index.
+   Only figures with set profiler are profiled
+   (see 'SetLayoutProfiler' in 'CFigure'),
+   counting hooks are installed only while any profiled branch runs,
+   so profiling costs nothing otherwise.
+   Layouts replayed from layout plans are not profiled.
+   One instance is meant to be shared by figures of a collection.
+   """
+########################################
+   counter_keys = ['calls', 'time_s', 'objects', 'deepcopies', 'merge_dicts']
+   record_keys = ['layout', 'rank', 'figure']
+
+   ## Hooks are shared by all profilers,
+   ## counters of running branches are local to threads
+   hooks_lock = threading.Lock()
+   hooks_cnt = 0
+   hooks_originals = None
+   local = threading.local()
+########################################
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.Clear()
+
+   def Clear(self):
+      with self.lock:
+         self.records = {}
+########################################
+   @classmethod
+   def count(cls, counter_key):
+      counters = getattr(cls.local, 'counters', None)
+      if counters:
+         counters[-1][counter_key] += 1
+
+   @classmethod
+   def installHooks(cls):
+      with cls.hooks_lock:
+         cls.hooks_cnt += 1
+         if cls.hooks_cnt > 1:
+            return
+         merge_dicts = fo.merge_dicts
+         init = fo.CFigObject.__dict__['__init__']
+         deepcopy = fo.CFigObject.__dict__['__deepcopy__']
+         cls.hooks_originals = (merge_dicts, init, deepcopy)
+
+         def merge_dicts_hook(*dicts):
+            cls.count('merge_dicts')
+            return merge_dicts(*dicts)
+         def init_hook(self, *args, **kwargs):
+            cls.count('objects')
+            init(self, *args, **kwargs)
+         def deepcopy_hook(self, memo):
+            cls.count('deepcopies')
+            return deepcopy(self, memo)
+
+         fo.merge_dicts = merge_dicts_hook
+         fo.CFigObject.__init__ = init_hook
+         fo.CFigObject.__deepcopy__ = deepcopy_hook
+
+   @classmethod
+   def uninstallHooks(cls):
+      with cls.hooks_lock:
+         cls.hooks_cnt -= 1
+         if cls.hooks_cnt > 0:
+            return
+         merge_dicts, init, deepcopy = cls.hooks_originals
+         fo.merge_dicts = merge_dicts
+         fo.CFigObject.__init__ = init
+         fo.CFigObject.__deepcopy__ = deepcopy
+         cls.hooks_originals = None
+########################################
+   ## Nested branches are recorded separately,
+   ## time of the outer one includes them
+   @contextmanager
+   def Profile(self, layout_key, rank, figure_idx):
+      counters = dict((counter_key, 0) for counter_key in self.counter_keys)
+      stack = getattr(self.local, 'counters', None)
+      if stack == None:
+         stack = self.local.counters = []
+      self.installHooks()
+      stack.append(counters)
+      start = time.time()
+      try:
+         yield
+      finally:
+         counters['time_s'] = time.time()-start
+         counters['calls'] = 1
+         stack.pop()
+         self.uninstallHooks()
+         self.addCounters((layout_key, rank, figure_idx), counters)
+
+   def addCounters(self, key, counters):
+      with self.lock:
+         record = self.records.get(key)
+         if record == None:
+            record = self.records[key] = dict((counter_key, 0) for counter_key in self.counter_keys)
+         for counter_key in self.counter_keys:
+            record[counter_key] += counters[counter_key]
+########################################
+   ## Rows of counters summed by given keys (subset of 'record_keys'),
+   ## the most time consuming first
+   def Report(self, keys=None):
+      if keys == None:
+         keys = self.record_keys
+      idxs = [self.record_keys.index(key) for key in keys]
+      rows = {}
+      with self.lock:
+         for record_key, record in self.records.items():
+            row_key = tuple(record_key[idx] for idx in idxs)
+            row = rows.get(row_key)
+            if row == None:
+               row = rows[row_key] = fo.merge_dicts(dict(zip(keys, row_key)),
+                  dict((counter_key, 0) for counter_key in self.counter_keys)
+               )
+            for counter_key in self.counter_keys:
+               row[counter_key] += record[counter_key]
+      return sorted(rows.values(), key=lambda row: (-row['time_s'], [row[key] for key in keys]))
+
+   def ReportStr(self, keys=None):
+      if keys == None:
+         keys = self.record_keys
+      lines = ["  ".join(keys+self.counter_keys)]
+      for row in self.Report(keys):
+         lines.append("  ".join(
+            ["%s" % (row[key],) for key in keys]
+            +["%d" % row['calls'], "%.6f" % row['time_s']]
+            +["%d" % row[counter_key] for counter_key in self.counter_keys[2:]]
+         ))
+      return "\n".join(lines)
+
+   ## 'dst' is path or file object
+   def DumpJSON(self, dst, keys=None):
+      report = self.Report(keys)
+      if isinstance(dst, basestring):
+         with open(dst, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+      else:
+         json.dump(report, dst, indent=1, sort_keys=True)
+################################################################################
+
 ################################################################################
 class CFigure(object):
    """
    Class that gathers several root figure objects
    and provides configurable draw tool and layouts above them
    """
+########################################
+   ## Used when classes are not given in 'Set'
+   default_draw_figure_class = CDrawFigurePrint
+   default_layout_figure_class = CLayoutFigureBase
 ########################################
    def __init__(self, resolution_ppi, width_mm, height_mm, name="", idx=None):
-      self._dummy_object = fo.CFigObject('dummy', resolution_ppi=resolution_ppi, width_mm=width_mm, height_mm=height_mm)
+      self._dummy_object = fo.CFigObject('dummy', resolution_ppi=resolution_ppi, width_mm=width_mm, height_mm=height_mm, figure=self)
       self._dummy_object.depth = -1
 
+      ## All inserted objects of the figure by their key base,
+      ## maintained by 'CFigObject' insertion and removal
+      self.objects_by_key_base = {}
+
       self.root_objects = self._dummy_object.objects_ordered
 
       self.draw = None
       self.layout = None
-
-      self.draw_flag = False
+      self.geometry_class = None
+      self.layout_plans = None
+      self.layout_pool = None
+      self.layout_tracking = False
+      self.layout_profiler = None
 
       self.name = name
       self.idx = idx
@@ -538,17 +1449,48 @@ class CFigure(object):
    def RootObjectsCount(self):
       return self._dummy_object.ObjectsCount
 
+   ## Register object and all its subobjects
+   def registerObjects(self, object_):
+      self.objects_by_key_base.setdefault(object_.ObjectKeyBase, []).append(object_)
+      for obj in object_.objects_ordered:
+         self.registerObjects(obj)
+
+   def unregisterObjects(self, object_):
+      objs = self.objects_by_key_base[object_.ObjectKeyBase]
+      objs.remove(object_)
+      if not objs:
+         del self.objects_by_key_base[object_.ObjectKeyBase]
+      for obj in object_.objects_ordered:
+         self.unregisterObjects(obj)
+
+   ## All objects with given key base within 'parent' (whole figure by default),
+   ## in preorder
+   def GetObjectsByKeyBase(self, key_base, parent=None):
+      if parent == None:
+         parent = self._dummy_object
+      objs = []
+      for obj in self.objects_by_key_base.get(key_base, []):
+         idx_path = obj.idxPathFrom(parent)
+         if idx_path:
+            objs.append((idx_path, obj))
+      objs.sort()
+      return [obj for idx_path, obj in objs]
+
+   ## Object with given key base of the first parent in preorder
+   ## that contains such objects
    def GetFirstObjectByKeyBase(self, key_base, idx=0, parent=None):
       if parent == None:
          parent = self._dummy_object
-      obj = parent.GetObjectByKeyBase(key_base, idx)
-      if obj != None:
-         return obj
-      for obj in parent.objects_ordered:
-         ret = self.GetFirstObjectByKeyBase(key_base, idx, obj)
-         if ret != None:
-            return ret
-      return None
+      first = None
+      for obj in self.objects_by_key_base.get(key_base, []):
+         idx_path = obj.parent.idxPathFrom(parent)
+         if idx_path != None and (first == None or idx_path < first[0]):
+            first = (idx_path, obj.parent)
+      return None if first == None else first[1].GetObjectByKeyBase(key_base, idx)
+
+   ## E.g. 'back/back_artifacts_group/back_class'
+   def GetObjectByPath(self, path):
+      return self._dummy_object.GetObjectByPath(path)
 ########################################
    @property
    def Width_mm(self):
@@ -580,7 +1522,7 @@ class CFigure(object):
    ## All attributes must be contained
    def SetDrawFigure(self, draw_figure_class=None, draw_object_class=None, **draw_figure_args):
       if draw_figure_class == None:
-         draw_figure_class = CDrawFigurePrint
+         draw_figure_class = self.default_draw_figure_class
       if draw_object_class == None:
          draw_object_class = draw_figure_class.default_draw_object_class
       self.draw = draw_figure_class(self, draw_object_class, **draw_figure_args)
@@ -589,9 +1531,37 @@ class CFigure(object):
    ## All attributes must be contained
    def SetLayoutFigure(self, layout_figure_class=None, **layout_figure_args):
       if layout_figure_class == None:
-         layout_figure_class = CLayoutFigureBase
+         layout_figure_class = self.default_layout_figure_class
       self.layout = layout_figure_class(self, **layout_figure_args)
 
+   ## Optional evaluator of geometry of all objects at once
+   ## before each draw (e.g. 'fig_geometry.CFigureGeometry'),
+   ## 'None' means lazy evaluation per object
+   def SetGeometryClass(self, geometry_class=None):
+      self.geometry_class = geometry_class
+
+   ## Optional shared 'CLayoutPlans' to replay complete layouts
+   ## of figures with the same inputs, 'None' means to always run layouts
+   def SetLayoutPlans(self, layout_plans=None):
+      self.layout_plans = layout_plans
+
+   ## Optional pool (e.g. 'multiprocessing.pool.ThreadPool')
+   ## to run independent layouts concurrently,
+   ## 'None' means to run layouts in order of their ranks
+   def SetLayoutPool(self, layout_pool=None):
+      self.layout_pool = layout_pool
+
+   ## Optional shared 'CLayoutProfiler' to profile layouts of figures,
+   ## 'None' means no profiling
+   def SetLayoutProfiler(self, layout_profiler=None):
+      self.layout_profiler = layout_profiler
+
+   ## Whether to track layouts to lay out again
+   ## only their branches affected by 'UpdateAttrs'.
+   ## Tracked figures are always laid out, not replayed from layout plans.
+   def SetLayoutTracking(self, layout_tracking=True):
+      self.layout_tracking = layout_tracking
+
    ## Set everything with all attributes,
    ## but one often wants to do these steps separately
    def Set(self,
@@ -606,26 +1576,78 @@ class CFigure(object):
    def DoLayout(self, rank_step=None, layout_step=None):
       if self.layout == None:
          return None
-      ret = self.layout.LayoutFigure(rank_step, layout_step)
-      self.draw_flag |= ret
+      if self.layout_tracking:
+         self.layout.TrackLayouts()
+      if self.layout_plans != None and rank_step == None and layout_step == None and self.layout.layouts_tracks == None:
+         ret = self.layout_plans.LayoutFigure(self)
+      elif rank_step == None and layout_step == None:
+         ret = self.layoutFigure()
+      else:
+         ret = self.layout.LayoutFigure(rank_step, layout_step)
+      return ret
+
+   ## Complete layout of figure
+   def layoutFigure(self):
+      if self.layout_pool == None:
+         return self.layout.LayoutFigure()
+      return self.layout.LayoutFigureGraph(self.layout_pool)
+
+   ## Updates attributes of layout figure (as 'layout_figure_args' in 'Set')
+   ## and lays out only affected branches of tracked layouts
+   ## (see 'UpdateAttrs' in 'CLayoutFigureBase'),
+   ## otherwise the whole figure is laid out again
+   def UpdateAttrs(self, **layout_figure_args):
+      if self.layout == None:
+         return None
+      ret = self.layout.UpdateAttrs(layout_figure_args)
+      if ret == None:
+         for obj in list(self.root_objects):
+            obj.UnsetParent()
+         self.layout.SetAttrs(dict(layout_figure_args))
+         ret = self.DoLayout()
       return ret
 
    ## Whole object and all its subobjects must be properly set at this moment!
    ## 'SetDrawFigure', 'SetLayout' must have been called before
+   ## Only root objects with dirty draw are drawn (see 'SetDrawDirty' in 'CFigObject'),
+   ## unless said explicitly
    def DoDraw(self, force_draw=False):
-      if self.draw == None or (not force_draw and not self.draw_flag):
+      if self.draw == None:
+         return
+      root_objects = [obj for obj in self.root_objects if force_draw or obj.IsDrawDirty]
+      if not root_objects:
          return
+
+      if self.geometry_class != None:
+         self.geometry_class(self).Eval()
+      else:
+         self.SolveGeometry()
       
       self.draw.PreDrawFigure()
-      for obj in self.root_objects:
-         obj.Draw()
+      for obj in root_objects:
+         obj.Draw(dirty_only=not force_draw and obj.draw.redraw_dirty_only)
       self.draw.PostDrawFigure()
 
-      self.draw_flag = False
+   ## Geometry of all objects is cached until the tree changes
+   def SolveGeometry(self):
+      self._dummy_object.SolveGeometry()
+
+   ## Whether any root object needs to be drawn
+   @property
+   def IsDrawDirty(self):
+      for obj in self.root_objects:
+         if obj.IsDrawDirty:
+            return True
+      return False
+
+   ## All root objects are treated as drawn (see 'ClearDrawDirty' in 'CFigObject')
+   def ClearDrawDirty(self):
+      for obj in self.root_objects:
+         obj.ClearDrawDirty()
 
    ## 'Set' should have been called before.
-   ## Draw only when any layout was processed,
-   ## or if said explicitly.
+   ## Draw only objects changed since the last draw,
+   ## or all if said explicitly.
    ## Returns whether any layout was processed.
    def Do(self, rank_step=None, layout_step=None, force_draw=False):
       ret = self.DoLayout(rank_step, layout_step)
@@ -697,6 +1719,49 @@ if __name__ == "__main__":
    w.Do()
    print
 
+   print "Figures with replayed layout plan:"
+   plans = CLayoutPlans()
+   for v in [CFigure(500, height_mm=100, width_mm=50) for idx in range(2)]:
+      v.SetLayoutPlans(plans)
+      v.Set(layout_figure_args={'layout_front':{'front_draw_object_args':{'effect_text':{'text':"Plan"}}}})
+      v.Do()
+   print "Recorded plans:", len(plans.plans)
+   print
+
+   print "Equal attributes of different types have their own plans:"
+   for text in [1, 1.0, True]:
+      v = CFigure(500, height_mm=100, width_mm=50)
+      v.SetLayoutPlans(plans)
+      v.Set(layout_figure_args={'layout_front':{'front_draw_object_args':{'effect_text':{'text':text}}}})
+      v.DoLayout()
+      print v.front.draw.AttrsFromEffects()['effect_text']['text'],
+   print
+   print "Recorded plans:", len(plans.plans)
+   print
+
+   print "Figure with concurrent layouts:"
+   from multiprocessing.pool import ThreadPool
+   pool = ThreadPool(2)
+   v = CFigure(500, height_mm=100, width_mm=50)
+   v.SetLayoutPool(pool)
+   v.Set(layout_figure_args={'layout_front':{'front_draw_object_args':{'effect_text':{'text':"Pool"}}}})
+   v.Do()
+   pool.close()
+   pool.join()
+   print
+
+   print "Figures with profiled layouts:"
+   profiler = CLayoutProfiler()
+   for v in [CFigure(500, height_mm=100, width_mm=50, idx=idx) for idx in range(2)]:
+      v.SetLayoutProfiler(profiler)
+      v.Set(layout_figure_args={'layout_front':{'front_draw_object_args':{'effect_text':{'text':"Profile"}}}})
+      v.Do()
+   for row in sorted(profiler.Report(['layout', 'rank']), key=lambda row: (row['layout'], row['rank'])):
+      print "%s %d: calls %d, objects %d, deep copies %d, merge_dicts %d" % (
+         row['layout'], row['rank'], row['calls'], row['objects'], row['deepcopies'], row['merge_dicts']
+      )
+   print
+
    print "-"*50
    print "\n*Group tests*\n"
    f1 = CFigure(300, height_mm=100, width_mm=100)
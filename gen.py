@@ -4,6 +4,7 @@ from __future__ import division
 from gimpfu import *
 
 import logging as log
+import os
 import sys
 
 log.basicConfig(stream=sys.stdout, level=log.WARNING)
@@ -30,6 +31,8 @@ def Gen(resolution):
       width_mm=width_mm, height_mm=height_mm,
       draw_figure_class=dg.CDrawFigureGimp,
       layout_figure_class=lm.CLayoutFigureMysteriaCard,
+      ## Only changed cards are generated again
+      build_manifest_path=os.path.join(dg.CDrawObjectGimp.output_dir, "gen_manifest.json"),
    )
    collection.SetLoader(fc.CLoaderDSV, delim='\t')
    
@@ -37,6 +40,8 @@ def Gen(resolution):
       print "\n<Processing '%s' ...>\n" % (fn)
       collection.LoadAndDoFigures(fn)
 
+   collection.FinishBuild()
+
 register(
    "python-fu-Mysteria-gen",                        #<- this is plugin name
    N_("Mysteria cards generating"),                 #<- brief description
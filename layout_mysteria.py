@@ -4,6 +4,7 @@
 
 from __future__ import division
 import copy as cp
+import sys
 
 import fig_object as fo
 import figure as fig
@@ -57,6 +58,12 @@ class CLayoutMysteriaCard_(fig.CLayout):
 
    local_ranks = [0,10]
    ranks_ = None
+
+   ## Front branches do not touch back except that 'mini' copies it
+   ranks_access = {
+      0 : ([], ['front']),
+      10 : (['front', 'back'], ['front']),
+   }
 ########################################
    def AddObjectBackMiniToLayout(self, xloc=fo.DEFAULT, add_xoffs_mm=fo.DEFAULT, add_yoffs_mm=fo.DEFAULT,
    ):
@@ -135,25 +142,38 @@ class CLayoutMysteriaCardHold_(CLayoutMysteriaCard_):
       },
    })
 
-   local_ranks = [0]
+   local_ranks = [0,1]
    ranks_ = None
+
+   ## Back groups are independent of front label and picture
+   ranks_access = fig.merge_ranks_access(CLayoutMysteriaCard_.ranks_access, {
+      0 : ([], ['front']),
+      1 : (['back'], ['back']),
+   })
 ########################################
-   def AddObjectIconToLayout(self, key, icons_obj,
+   ## Returns triple of key, scale and arguments of 'AddObjectToGroup'
+   ## for 'AddObjectIconsToLayout'
+   @fo.attr_defaults_args('key', 2)
+   def IconSpec(self, key,
       scale=fo.DEFAULT,
       add_xoffs_mm=fo.DEFAULT,
       opacity=fo.DEFAULT,
       **draw_object_args
    ):
-      self.SetFunctionAttrDefaults(key,3)
-      obj = self.AddObjectToGroup(key, icons_obj,
-         xloc='rightof', add_xoffs_mm=add_xoffs_mm,
-         opacity=opacity,
-         **draw_object_args
-      )
-      obj.SetSizeFromObject(self.back, scale=self.args.scale)
-      obj.AddDrawEffectFromObject(self.back, 'border')
-      self.CleanFunctionAttrDefaults()
-      return obj
+      return (key, scale, fo.merge_dicts(draw_object_args, {
+         'xloc' : 'rightof', 'add_xoffs_mm' : add_xoffs_mm,
+         'opacity' : opacity,
+      }))
+
+   ## Icons are inserted in a row at once (see 'IconSpec')
+   def AddObjectIconsToLayout(self, icons_obj, icons):
+      def set_icon(obj, idx):
+         obj.SetSizeFromObject(self.back, scale=icons[idx][1])
+         obj.AddDrawEffectFromObject(self.back, 'border')
+      return self.AddObjectsToGroup(icons_obj, [(key, args) for key, scale, args in icons], set_f=set_icon)
+
+   def AddObjectIconToLayout(self, key, icons_obj, **args):
+      return self.AddObjectIconsToLayout(icons_obj, [self.IconSpec(key, **args)])[0]
 
    def AddObjectPrestigeToLayout(self):
       key = 'prestige'
@@ -168,19 +188,22 @@ class CLayoutMysteriaCardHold_(CLayoutMysteriaCard_):
    def Layout(self, rank=0):
       CLayoutMysteriaCard_.Layout(self, rank)
       if rank == 0:
+         prestige_group = self.AddObjectPrestigeToLayout()
+      elif rank == 1:
          importance_left = self.AddObjectGroupToLayout('importance', parent=self.back)
-         category_importance_left = self.AddObjectToGroup('category_importance', parent=importance_left, effect_text={'text':str(self.category_importance)})
-         class_importance_left = self.AddObjectToGroup('class_importance', parent=importance_left)
+         category_importance_left, class_importance_left = self.AddObjectsToGroup(importance_left, [
+            ('category_importance', {'effect_text':{'text':str(self.category_importance)}}),
+            ('class_importance', {}),
+         ])
          importance_right = self.AddObjectCopyToLayout(importance_left, xloc='mirror')
 
          back_artifacts = self.AddObjectGroupToLayout('back_artifacts', parent=self.back)
-         back_artifacts.SetPosFromObject(importance_left,
-            xloc=None, yloc='below', add_yoffs_mm=self.back_artifacts_group_add_yoffs_mm,
-         )
+         with self.Locked():
+            back_artifacts.SetPosFromObject(importance_left,
+               xloc=None, yloc='below', add_yoffs_mm=self.back_artifacts_group_add_yoffs_mm,
+            )
 
          category_icons = self.AddObjectGroupToLayout('category_icons', self.back)
-
-         prestige_group = self.AddObjectPrestigeToLayout()
       return self.ReturnRank(rank)
 ################################################################################
 
@@ -214,16 +237,22 @@ class CLayoutMysteriaCardPlay_(CLayoutMysteriaCardHold_):
       },
    })
 
-   local_ranks = [0,1]
+   local_ranks = [0,2]
    ranks_ = None
+
+   ranks_access = fig.merge_ranks_access(CLayoutMysteriaCardHold_.ranks_access, {
+      0 : (['front'], ['front']),
+      2 : (['back'], ['back']),
+   })
 ########################################
    def Layout(self, rank=0):
       CLayoutMysteriaCardHold_.Layout(self, rank)
       if rank == 0:
          if self.play_with_draw_object_args['effect_text']['text'] != "":
             play_with = self.AddObjectCopyToLayout(self.front.GetObjectByKeyBase('label'), new_key='play_with')
-            play_with.SetDrawEffectAttrs('text', text="+"+play_with.draw.AttrsFromEffects()['effect_text']['text'])
-      elif rank == 1:
+            with self.Locked():
+               play_with.SetDrawEffectAttrs('text', text="+"+play_with.draw.AttrsFromEffects()['effect_text']['text'])
+      elif rank == 2:
          if self.force_play:
             back_force_play = self.AddObjectToGroup('back_force_play', parent=self.back.GetObjectByKeyBase('back_artifacts_group'))
       return self.ReturnRank(rank)
@@ -272,17 +301,23 @@ class CLayoutMysteriaCardClass(CLayoutMysteriaCardPlay_):
       },
    })
 
-   local_ranks = [0,11]
+   local_ranks = [1,11]
    ranks_ = None
+
+   ranks_access = fig.merge_ranks_access(CLayoutMysteriaCardPlay_.ranks_access, {
+      1 : (['back'], ['back']),
+      11 : (['front'], ['front']),
+   })
 ########################################
    def Layout(self, rank=0):
       CLayoutMysteriaCardPlay_.Layout(self, rank)
-      if rank == 0:
+      if rank == 1:
          back_class = self.AddObjectToGroup('back_class', parent=self.back.GetObjectByKeyBase('back_artifacts_group'))
       elif rank == 11:
          front_class = self.AddObjectToLayout('front_class', parent=self.front)
-         front_class.SetPosFromObject(self.front.GetObjectByKeyBase('mini'), xloc='mirror', yloc=None)
-         front_class.SetPosFromObject(self.front.GetObjectByKeyBase('label'), xloc=None, yloc='centerof')
+         with self.Locked():
+            front_class.SetPosFromObject(self.front.GetObjectByKeyBase('mini'), xloc='mirror', yloc=None)
+            front_class.SetPosFromObject(self.front.GetObjectByKeyBase('label'), xloc=None, yloc='centerof')
       return self.ReturnRank(rank)
 ################################################################################
 
@@ -312,20 +347,26 @@ class CLayoutMysteriaCardSpell(CLayoutMysteriaCardPlay_):
       },
    })
 
-   local_ranks = [0,11]
+   local_ranks = [1,11]
    ranks_ = None
+
+   ranks_access = fig.merge_ranks_access(CLayoutMysteriaCardPlay_.ranks_access, {
+      1 : (['back'], ['back']),
+      11 : (['front'], ['front']),
+   })
 ########################################
    def Layout(self, rank=0):
       CLayoutMysteriaCardPlay_.Layout(self, rank)
-      if rank == 0:
+      if rank == 1:
          spell_class = self.AddObjectToGroup('spell_class', parent=self.back.GetObjectByKeyBase('back_artifacts_group'),
             effect_text={'text':str(self.spell_class)}
          )
       elif rank == 11:
          spell_mana = self.AddObjectToLayout('spell_mana', parent=self.front, effect_text={'text':str(self.spell_mana)})
          mini = self.front.GetObjectByKeyBase('mini')
-         spell_mana.SetSizeFromObject(mini, set_margin=False)
-         spell_mana.SetPosFromObject(mini, xloc='mirror')
+         with self.Locked():
+            spell_mana.SetSizeFromObject(mini, set_margin=False)
+            spell_mana.SetPosFromObject(mini, xloc='mirror')
       return self.ReturnRank(rank)
 ################################################################################
 
@@ -385,8 +426,16 @@ class CLayoutMysteriaCardAddKind(CLayoutMysteriaCardPlay_):
       },
    })
 
-   local_ranks = [0]
+   local_ranks = [0,1]
    ranks_ = None
+
+   ## It does not inherit branches of superclasses
+   layout_reads = []
+   layout_writes = []
+   ranks_access = {
+      0 : (['front'], ['front']),
+      1 : (['front', 'back'], ['back']),
+   }
 ########################################
    def AddObjectKindLabelToLayout(self, label_obj,
       add_yoffs_mm=fo.DEFAULT,
@@ -403,7 +452,9 @@ class CLayoutMysteriaCardAddKind(CLayoutMysteriaCardPlay_):
 ########################################
    def Layout(self, rank=0):
       if rank == 0:
-         front_kind_label_obj = self.AddObjectKindLabelToLayout(self.front.GetObjectByKeyBase('label'))
+         self.AddObjectKindLabelToLayout(self.front.GetObjectByKeyBase('label'))
+      elif rank == 1:
+         front_kind_label_obj = self.front.GetObjectByKeyBase('kind_label')
          back_kind_label_obj = self.AddObjectCopyToLayout(front_kind_label_obj,
             new_key='back_kind_label',
             new_parent=self.back,
@@ -411,9 +462,10 @@ class CLayoutMysteriaCardAddKind(CLayoutMysteriaCardPlay_):
          )
          self.addObjectToGroup(parent=self.back.GetObjectByKeyBase('back_artifacts_group'), object_=back_kind_label_obj)
 
-         no_steal_obj = self.AddObjectIconToLayout('no_steal', self.back.GetObjectByKeyBase('category_icons_group'))
+         icons = [self.IconSpec('no_steal')]
          if self.no_dump:
-            no_dump_obj = self.AddObjectIconToLayout('no_dump', self.back.GetObjectByKeyBase('category_icons_group'))
+            icons.append(self.IconSpec('no_dump'))
+         self.AddObjectIconsToLayout(self.back.GetObjectByKeyBase('category_icons_group'), icons)
       return self.ReturnRank(rank)
 ################################################################################
 
@@ -511,6 +563,55 @@ if __name__ == "__main__":
 
    print "Front effects as attributes: ", x.front.draw.AttrsFromEffects()
    print "Back effects as attributes: ", x.back.draw.AttrsFromEffects()
+   print "-"*20
+
+   print "Spell card with updated mana (only 'spell_mana' object laid out again):"
+   y = fig.CFigure(300, height_mm=80, width_mm=58)
+   y.SetLayoutTracking()
+   y.Set(layout_figure_class=CLayoutFigureMysteriaCard, layout_figure_args={
+      'layout_mysteria_card_spell':{'flag':True},
+   })
+   y.DoLayout()
+   spell_mana = y.front.GetObjectByKeyBase('spell_mana')
+   label = y.front.GetObjectByKeyBase('label')
+   y.UpdateAttrs(layout_mysteria_card_spell={'spell_mana':3})
+   print "Mana:", y.front.GetObjectByKeyBase('spell_mana').draw.AttrsFromEffects()['effect_text']['text']
+   print "Mana object replaced:", y.front.GetObjectByKeyBase('spell_mana') is not spell_mana
+   print "Label object kept:", y.front.GetObjectByKeyBase('label') is label
+   print "-"*20
+
+   print "Cards laid out repeatedly by thread pool (same as serial):"
+   from multiprocessing.pool import ThreadPool
+   def tree(x):
+      objs = list(x.root_objects)
+      for obj in objs:
+         objs.extend(obj.objects_ordered)
+      return [(obj.ObjectPath, obj.idx, obj.Size_mm, obj.AbsBegin_mm,
+         None if obj.draw == None else obj.draw.AttrsFromEffects()) for obj in objs]
+   cards_args = [
+      {'layout_mysteria_card_class':{'flag':True, 'prestige':2}},
+      {'layout_mysteria_card_spell':{'flag':True, 'prestige':1}},
+      {'layout_mysteria_card_class':{'flag':True, 'force_play':True, 'prestige':-1, 'mini_2':True}},
+   ]
+   pool = ThreadPool(4)
+   ## Frequent switches of threads make races likely
+   check_interval = sys.getcheckinterval()
+   sys.setcheckinterval(1)
+   same = True
+   for rep in range(20):
+      for args in cards_args:
+         trees = []
+         for layout_pool in [None, pool]:
+            z = fig.CFigure(300, height_mm=80, width_mm=58)
+            z.SetLayoutPool(layout_pool)
+            z.Set(layout_figure_class=CLayoutFigureMysteriaCard, layout_figure_args=args)
+            z.DoLayout()
+            trees.append(tree(z))
+         same = same and trees[0] == trees[1]
+   sys.setcheckinterval(check_interval)
+   pool.close()
+   pool.join()
+   print "Same:", same
 
 ################################################################################
 ################################################################################